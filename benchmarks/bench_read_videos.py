@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Compare the old row by row videos parser with utils.videos_from_dataframe
+on a synthetic sheet. Run from the repository root:
+    python benchmarks/bench_read_videos.py [rows]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import videos_from_dataframe
+from synthetic import synthetic_videos_sheet
+
+
+def legacy_videos_dict_from_dataframe(data_from_xls):
+    # read_videos_xls before it was vectorized, kept here as the reference
+    data_dict = {}
+    for index, row in data_from_xls.iterrows():
+        if row["Link to Content"] == "N/A" or row["Content Type"] == "Assessment":
+            continue
+        language = row["Language"].lower().strip()
+        if language not in data_dict:
+            data_dict[language] = {}
+        grade = row["Grade"]
+        if grade not in data_dict[language]:
+            data_dict[language][grade] = {}
+        subject = row["Subject"].lower().strip()
+        if subject not in data_dict[language][grade]:
+            data_dict[language][grade][subject] = {}
+        chapter = "{} - {}".format(row["Chapter No"], row["Chapter Name"].lower().strip())
+        if chapter not in data_dict[language][grade][subject]:
+            data_dict[language][grade][subject][chapter] = {}
+        topic_name = row["Topic Name"].lower().strip()
+        if topic_name not in data_dict[language][grade][subject][chapter]:
+            data_dict[language][grade][subject][chapter][topic_name] = {}
+        content_type = row["Content Type"].lower().strip()
+        if content_type not in data_dict[language][grade][subject][chapter][topic_name]:
+            data_dict[language][grade][subject][chapter][topic_name][content_type] = {}
+        link = row["Link to Content"].lower().strip()
+        if link not in data_dict[language][grade][subject][chapter][topic_name][content_type]:
+            data_dict[language][grade][subject][chapter][topic_name][content_type][link] = {
+                "title": row["Video/Assessment Title"],
+                "copyright": row["Copyright"],
+                "license": row["License"],
+                "icon": row["Icon"]
+            }
+    return data_dict
+
+
+def same_output(a, b):
+    # NaN != NaN, so compare through repr which keeps key order too
+    return repr(a) == repr(b)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sheet = synthetic_videos_sheet(rows)
+
+    old, old_time = timed(legacy_videos_dict_from_dataframe, sheet)
+    new, new_time = timed(videos_from_dataframe, sheet)
+
+    print("rows: {}".format(rows))
+    print("iterrows parser:   {:.3f}s".format(old_time))
+    print("vectorized parser: {:.3f}s ({:.1f}x)".format(new_time, old_time / new_time))
+    if not same_output(old, new.to_dict()):
+        print("Error: parsers produced different output")
+        sys.exit(1)
+    print("outputs identical")
@@ -0,0 +1,134 @@
+"""
+Local stand-in for the Dropbox endpoints the chef uses
+Metadata calls are answered in process by FakeDropbox, file bodies are served
+over plain HTTP by FakeContentServer, both with configurable latency and throughput
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLinkMetadata(object):
+    """
+    The fields of dropbox.sharing.FileLinkMetadata the chef reads
+    """
+    def __init__(self, url, size):
+        self.url = url
+        self.name = url.split("?")[0].rsplit("/", 1)[-1]
+        self.size = size
+        self.rev = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        self.path_lower = "/{}/{}".format(self.rev, self.name.lower())
+
+
+class FakeFileMetadata(object):
+    """
+    The fields of dropbox.files.FileMetadata the chef reads
+    """
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+
+
+def fake_body(link, size):
+    # deterministic bytes per link so content hashes are stable across runs
+    seed = hashlib.sha256(link.encode('utf-8')).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def fake_content_hash(body, block_size=4 * 1024 * 1024):
+    # same algorithm as downloads.dropbox_content_hash, on bytes in memory
+    block_hashes = b''.join(hashlib.sha256(body[start:start + block_size]).digest()
+                            for start in range(0, len(body), block_size))
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+class FakeDropbox(object):
+    """
+    Answers sharing_get_shared_link_metadata and files_get_metadata after `latency` seconds
+    """
+    def __init__(self, file_size, latency=0.0):
+        self.file_size = file_size
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.metadata_calls = 0
+        self.links = {}
+
+    def sharing_get_shared_link_metadata(self, url):
+        time.sleep(self.latency)
+        metadata = FakeLinkMetadata(url, self.file_size)
+        with self.lock:
+            self.metadata_calls += 1
+            self.links[metadata.path_lower] = url
+        return metadata
+
+    def files_get_metadata(self, path):
+        time.sleep(self.latency)
+        with self.lock:
+            self.metadata_calls += 1
+            url = self.links[path]
+        return FakeFileMetadata(fake_content_hash(fake_body(url, self.file_size)))
+
+
+class FakeContentServer(object):
+    """
+    HTTP server for the get_shared_link_file endpoint on localhost
+    Each response waits `latency` seconds, then sends the body at `throughput`
+    bytes per second per connection (None for as fast as possible), honoring Range
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file_size, latency=0.0, throughput=None):
+        self.file_size = file_size
+        self.latency = latency
+        self.throughput = throughput
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/2/sharing/get_shared_link_file".format(self.server.server_address[1])
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                time.sleep(fake.latency)
+                link = json.loads(self.headers["Dropbox-API-Arg"])["url"]
+                body = fake_body(link, fake.file_size)
+                status = 200
+                range_header = self.headers.get("Range")
+                if range_header:
+                    body = body[int(range_header.split("=")[1].rstrip("-")):]
+                    status = 206
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                for start in range(0, len(body), fake.CHUNK_SIZE):
+                    chunk = body[start:start + fake.CHUNK_SIZE]
+                    self.wfile.write(chunk)
+                    if fake.throughput:
+                        time.sleep(len(chunk) / fake.throughput)
+                with fake.lock:
+                    fake.bytes_sent += len(body)
+                    fake.requests += 1
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the chef on synthetic sheets and a local fake Dropbox
+Times read_videos_xls, read_assessment_xls, the video downloads, upload_content
+and construct_channel (cold and warm), and writes the results as json.
+Run from the repository root:
+    python benchmarks/run_benchmarks.py --video-rows 10000 --output bench.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_dropbox import FakeContentServer, FakeDropbox
+from synthetic import write_sheets
+
+
+class Recorder(object):
+    """
+    Collects wall time and, if trace_memory, peak traced memory per stage
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    def run(self, name, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            peak_mb = None
+            if self.trace_memory:
+                peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+                tracemalloc.stop()
+            self.results[name] = {"seconds": round(seconds, 4), "peak_mb": peak_mb}
+            print("{:<22} {:>9.3f}s {:>9}MB".format(name, seconds, peak_mb if peak_mb is not None else "-"))
+
+
+def count(data):
+    videos = questions = 0
+    for language, grade, subject, chapter in data.chapters():
+        for topic in chapter.topics.values():
+            videos += len(topic.videos)
+            questions += len(topic.questions)
+    return {"videos": videos, "questions": questions}
+
+
+def download_all(chef, data, concurrency):
+    queue = chef.start_downloads("fake-token", concurrency)
+    for language, grade, subject, chapter in data.chapters():
+        for topic in chapter.topics.values():
+            for link, video in topic.videos.items():
+                chef.queue_video(queue, link, video, (language.name, grade.grade, subject.name, chapter.name, topic.name))
+    return chef.finish_downloads(queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video-rows", type=int, default=1000, help="rows in videos.xls")
+    parser.add_argument("--assessment-rows", type=int, default=None, help="rows in assessments.xls (default: video rows)")
+    parser.add_argument("--file-size", type=int, default=64, help="size of every fake video in KB")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every fake Dropbox call")
+    parser.add_argument("--throughput", type=float, default=None, help="bytes per second per download (default: unlimited)")
+    parser.add_argument("--concurrency", type=int, default=8, help="download workers")
+    parser.add_argument("--workdir", default=None, help="where sheets and chefdata are written (default: a temp dir)")
+    parser.add_argument("--output", default="bench_results.json", help="json results file")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows parsing down")
+    args = parser.parse_args()
+    assessment_rows = args.video_rows if args.assessment_rows is None else args.assessment_rows
+    output = os.path.abspath(args.output)
+    file_size = args.file_size * 1024
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tictaclearn-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    start = time.perf_counter()
+    videos_xls, assessments_xls = write_sheets(workdir, args.video_rows, assessment_rows)
+    print("Wrote synthetic sheets to {} in {:.1f}s".format(workdir, time.perf_counter() - start))
+
+    # the chef resolves its folders relative to the working directory on import
+    os.chdir(workdir)
+    os.makedirs("credentials", exist_ok=True)
+    with open(os.path.join("credentials", "credentials.json"), 'w') as f:
+        json.dump({"dropbox_token": "fake-token"}, f)
+
+    import downloads
+    import sushichef
+    import utils
+    from metrics import METRICS
+
+    fake_dropbox = FakeDropbox(file_size, args.latency)
+    recorder = Recorder(trace_memory=not args.no_memory)
+    with FakeContentServer(file_size, args.latency, args.throughput) as server:
+        downloads.SHARED_LINK_FILE_URL = server.url
+        chef = sushichef.TicTacLearnChef()
+        chef.get_dropbox_client = lambda token: fake_dropbox
+        utils.FAILURES.start(sushichef.FAILURES_LOG)
+
+        data = recorder.run("read_videos_xls", utils.read_videos_xls, videos_xls)
+        data = recorder.run("read_assessment_xls", utils.read_assessment_xls, assessments_xls, data)
+        videos = recorder.run("download_videos", download_all, chef, data, args.concurrency)
+        exercises = recorder.run("build_exercises", chef.build_exercises, data)
+        recorder.run("upload_content", chef.upload_content, data, chef.get_channel(), videos, exercises)
+        downloaded = server.bytes_sent
+
+        shutil.rmtree("chefdata")
+        kwargs = {"concurrency": str(args.concurrency)}
+        recorder.run("construct_channel_cold", chef.construct_channel, **kwargs)
+        recorder.run("construct_channel_warm", chef.construct_channel, **kwargs)
+
+    download_seconds = recorder.results["download_videos"]["seconds"]
+    results = {
+        "config": dict(vars(args), assessment_rows=assessment_rows, workdir=workdir),
+        "counts": count(data),
+        "stages": recorder.results,
+        "download": {
+            "bytes": downloaded,
+            "mb_per_second": round(downloaded / 1024 / 1024 / download_seconds, 2) if download_seconds else None,
+            "metadata_calls": fake_dropbox.metadata_calls,
+            "body_requests": server.requests,
+        },
+        "metrics": METRICS.report(),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print("Results written to {}".format(output))
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Synthetic videos.xls / assessments.xls sheets with the column layout utils.py expects
+"""
+import os
+
+import pandas
+
+# videos.xls has inconsistent casing and spacing, assessments.xls does not
+LANGUAGES = ["English", " Hindi", "MARATHI ", "Gujarati"]
+MEDIUMS = ["English", "Hindi", "Marathi", "Gujarati"]
+SUBJECTS = ["Mathematics", "Science ", "english"]
+ASSESSMENT_SUBJECTS = ["Maths", "Science", "English"]
+CONTENT_TYPES = ["Video", "Video", "Video", "Assessment"]
+QUESTIONS_PER_SET = 10
+IMAGE = "Images/Grade 1/Chapter 1/question.png"
+
+
+def row_levels(i):
+    """
+    (language index, grade, subject index, chapter number, topic number) of videos row i
+    """
+    return i % 4, i // 4 % 10 + 1, i // 40 % 3, i // 120 % 20 + 1, i // 2400 % 5
+
+
+def is_video_row(i):
+    # every 101st row has no link and every fourth group of 7 rows is an assessment
+    return i % 101 != 0 and CONTENT_TYPES[i // 7 % 4] == "Video"
+
+
+def video_link(i):
+    # every 97th row repeats the link of the row before it
+    return "https://www.dropbox.com/s/{:08d}/Video%20{}.mp4?dl=0".format(i - 1 if i % 97 == 1 else i, i)
+
+
+def synthetic_videos_sheet(rows):
+    """
+    DataFrame with the videos.xls columns, including the messy casing and
+    spacing of the client sheets, N/A links and assessment rows
+    """
+    records = []
+    for i in range(rows):
+        language, grade, subject, chapter_no, topic = row_levels(i)
+        records.append({
+            "Language": LANGUAGES[language],
+            "Grade": grade,
+            "Subject": SUBJECTS[subject],
+            "Chapter No": chapter_no,
+            "Chapter Name": " Chapter {} ".format(chapter_no),
+            "Topic Name": "Topic {}".format(topic),
+            "Content Type": CONTENT_TYPES[i // 7 % 4],
+            "Video/Assessment Title": "Video {}".format(i),
+            "Link to Content": video_link(i) if i % 101 else "N/A",
+            "Copyright": "TicTacLearn",
+            "License": "CC BY",
+            "Icon": float("nan"),
+        })
+    return pandas.DataFrame.from_records(records)
+
+
+def synthetic_assessments_sheet(rows, video_rows):
+    """
+    DataFrame with the assessments.xls columns. Every question lands in a
+    language/grade/subject that the videos sheet of video_rows rows has
+    """
+    records = []
+    for j in range(rows):
+        question_set = j // QUESTIONS_PER_SET
+        i = question_set * 7 % video_rows
+        while not is_video_row(i):
+            i = (i + 1) % video_rows
+        language, grade, subject, chapter_no, topic = row_levels(i)
+        chapter_name = "Chapter {}".format(chapter_no)
+        if question_set % 3:
+            question_set_name = "Topic {} | {} | {} | Grade {} | {}".format(
+                topic, chapter_name, ASSESSMENT_SUBJECTS[subject], grade, MEDIUMS[language])
+        else:
+            question_set_name = "{} | {} | Grade {} | {}".format(
+                chapter_name, ASSESSMENT_SUBJECTS[subject], grade, MEDIUMS[language])
+        image_only = j % 10 == 0
+        records.append({
+            "Question Set Name": question_set_name,
+            "Medium": MEDIUMS[language],
+            "Class": grade,
+            "Subject": ASSESSMENT_SUBJECTS[subject],
+            "ChapterNo": chapter_no,
+            "QuestionId": "Q{}".format(j),
+            "QuestionText": float("nan") if image_only else "Question {}?".format(j),
+            "QuestionImage": IMAGE if image_only else float("nan"),
+            "Option1": "Yes",
+            "Option1Image": float("nan"),
+            "Option2": "No",
+            "Option2Image": float("nan"),
+            "Option3": float("nan") if j % 2 else "Maybe",
+            "Option3Image": float("nan"),
+            "Option4": float("nan"),
+            "Option4Image": float("nan") if j % 4 else IMAGE,
+            "AnswerNo": j % 2 + 1,
+        })
+    return pandas.DataFrame.from_records(records)
+
+
+def write_sheets(folder, video_rows, assessment_rows):
+    """
+    Write videos.xls, assessments.xls and the referenced image under folder/files
+    The sheets are xlsx workbooks saved under the .xls names the chef reads;
+    pandas.read_excel detects the format from the file contents
+    """
+    files_dir = os.path.join(folder, "files")
+    image_path = os.path.join(files_dir, *IMAGE.split("/"))
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    with open(image_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+
+    videos_xls = os.path.join(files_dir, "videos.xls")
+    assessments_xls = os.path.join(files_dir, "assessments.xls")
+    synthetic_videos_sheet(video_rows).to_excel(videos_xls, index=False, engine="openpyxl")
+    synthetic_assessments_sheet(assessment_rows, video_rows).to_excel(assessments_xls, index=False, engine="openpyxl")
+    return videos_xls, assessments_xls
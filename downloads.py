@@ -0,0 +1,324 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from dropbox import exceptions as dropbox_exceptions
+
+# Dropbox hashes files in 4MB blocks, see
+# https://www.dropbox.com/developers/reference/content-hash
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)    # seconds to connect and between received bytes, a stalled transfer is retried
+SHARED_LINK_FILE_URL = "https://content.dropboxapi.com/2/sharing/get_shared_link_file"
+
+
+def dropbox_content_hash(path):
+    """
+    Compute the Dropbox content_hash of a local file
+    """
+    block_hashes = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(DROPBOX_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            block_hashes += hashlib.sha256(block).digest()
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+def write_json_atomic(path, data):
+    """
+    Write data as json to a temporary file and move it over path so readers
+    never see a half written file
+    """
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class IncompleteDownloadError(IOError):
+    pass
+
+
+def stream_shared_link_file(session, token, link, metadata, part_path, chunk_size=DOWNLOAD_CHUNK_SIZE, throttle=None):
+    """
+    Stream the file behind a shared link to part_path in chunks of chunk_size bytes
+    If part_path already holds the start of the file the download resumes where it stopped
+    throttle(nbytes), if given, is called before each chunk is written
+    """
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset > metadata.size:
+        # left over from something else, start over
+        offset = 0
+
+    if offset < metadata.size:
+        headers = {
+            "Authorization": "Bearer {}".format(token),
+            "Dropbox-API-Arg": json.dumps({"url": link}),
+        }
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+        with session.post(SHARED_LINK_FILE_URL, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as res:
+            res.raise_for_status()
+            if offset and res.status_code != 206:
+                # range was ignored and the whole body is coming back
+                offset = 0
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    f.write(chunk)
+
+    downloaded = os.path.getsize(part_path)
+    if downloaded != metadata.size:
+        raise IncompleteDownloadError("Incomplete download of {}: got {} of {} bytes".format(link, downloaded, metadata.size))
+    return part_path
+
+
+def retry_after(exception):
+    """
+    Seconds the server asked us to wait before retrying, 0 if the error is worth
+    retrying without a hint and None if it is not worth retrying at all
+    """
+    if isinstance(exception, dropbox_exceptions.RateLimitError):
+        return exception.backoff or 0
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        status = exception.response.status_code
+        if status != 429 and status < 500:
+            return None
+        try:
+            return float(exception.response.headers.get("Retry-After", 0))
+        except ValueError:
+            return 0
+    if isinstance(exception, (dropbox_exceptions.InternalServerError, requests.ConnectionError,
+            requests.Timeout, requests.exceptions.ChunkedEncodingError, IncompleteDownloadError)):
+        return 0
+    return None
+
+
+class DownloadScheduler(object):
+    """
+    Shared limits for all download workers:
+      - bytes_per_second: global transfer cap, None for no cap
+      - max_disk_bytes: most bytes that in-flight downloads may hold on disk, None for no cap.
+        Transfers waiting for space are let in by priority, lowest first
+      - retries: attempts after the first for rate limited or transient errors, waiting
+        backoff * 2 ** attempt seconds (or the server's retry-after hint) in between
+    """
+    def __init__(self, bytes_per_second=None, max_disk_bytes=None, retries=5, backoff=1.0, max_backoff=300.0):
+        self.bytes_per_second = bytes_per_second
+        self.max_disk_bytes = max_disk_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.next_send = time.monotonic()
+        self.disk = threading.Condition()
+        self.disk_in_flight = 0
+        self.disk_waiters = []
+        self.order = itertools.count()
+
+    def throttle(self, nbytes):
+        """
+        Sleep until nbytes may be transferred without going over bytes_per_second across all threads
+        """
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_send, now)
+            self.next_send = start + nbytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def reserve_disk(self, nbytes, priority=()):
+        """
+        Hold nbytes of the disk budget while the block runs
+        A download larger than the whole budget still runs once nothing else is in flight
+        """
+        if not self.max_disk_bytes:
+            yield
+            return
+        waiter = (priority, next(self.order))
+        with self.disk:
+            heapq.heappush(self.disk_waiters, waiter)
+            while self.disk_waiters[0] != waiter or \
+                    (self.disk_in_flight and self.disk_in_flight + nbytes > self.max_disk_bytes):
+                self.disk.wait()
+            heapq.heappop(self.disk_waiters)
+            self.disk_in_flight += nbytes
+            self.disk.notify_all()
+        try:
+            yield
+        finally:
+            with self.disk:
+                self.disk_in_flight -= nbytes
+                self.disk.notify_all()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call function, retrying rate limited and transient failures with exponential backoff
+        """
+        for attempt in itertools.count():
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                hint = retry_after(e)
+                if hint is None or attempt >= self.retries:
+                    raise
+                delay = max(hint, min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1))
+                print("{}: {}. Retrying in {:.1f}s".format(type(e).__name__, e, delay))
+                time.sleep(delay)
+
+
+class ContentStore(object):
+    """
+    Folder of files named after their Dropbox content_hash, so byte identical
+    files reached through different links are only stored once
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.rev_locks = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def lock_for(self, rev):
+        """
+        Lock held while a file version is downloaded so two links sharing it
+        do not write the same part file at once
+        """
+        with self.lock:
+            return self.rev_locks.setdefault(rev, threading.Lock())
+
+    def part_path(self, metadata):
+        # rev is unique per file version, so part files of different links never collide
+        return os.path.join(self.folder, "{}.part".format(metadata.rev))
+
+    def path_for(self, content_hash, name):
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(self.folder, "{}{}".format(content_hash, extension))
+
+    def add(self, path, name, expected_hash=None):
+        """
+        Move the file at path into the store and verify it against expected_hash
+        Returns the (stored path, content_hash) pair
+        """
+        content_hash = dropbox_content_hash(path)
+        if expected_hash and content_hash != expected_hash:
+            os.remove(path)
+            raise IOError("Content hash mismatch for {}: expected {} got {}".format(name, expected_hash, content_hash))
+
+        stored_path = self.path_for(content_hash, name)
+        with self.lock:
+            if os.path.isfile(stored_path):
+                # same bytes already stored through another link
+                os.remove(path)
+            else:
+                os.replace(path, stored_path)
+        return stored_path, content_hash
+
+
+class VideoManifest(object):
+    """
+    On-disk record of every shared link resolved so far
+    Manifest structure:
+        link > {name, size, rev, content_hash, path}
+    Entries are appended to a log as they are recorded, so a run that is killed
+    before save() keeps every video it stored. save() folds the log into the manifest
+    """
+    def __init__(self, path):
+        self.path = path
+        self.log_path = "{}l".format(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                try:
+                    self.entries = json.loads(f.read())
+                except ValueError:
+                    print('Could not read manifest {}. Starting a new one'.format(path))
+        if os.path.isfile(self.log_path):
+            with open(self.log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        link, entry = json.loads(line)
+                    except ValueError:
+                        # last line cut short by the kill
+                        continue
+                    self.entries[link] = entry
+        self.by_rev = {entry["rev"]: entry for entry in self.entries.values()}
+
+    def get(self, link):
+        with self.lock:
+            return self.entries.get(link)
+
+    def get_complete(self, link):
+        """
+        Return the entry for link if its local copy is still complete
+        """
+        entry = self.get(link)
+        if entry and os.path.isfile(entry["path"]) and os.path.getsize(entry["path"]) == entry["size"]:
+            return entry
+        return None
+
+    def is_current(self, link, metadata):
+        """
+        True if link was downloaded before, the remote file has not changed since
+        and the local copy is still complete
+        """
+        entry = self.get_complete(link)
+        return entry is not None and entry["rev"] == metadata.rev
+
+    def find_by_rev(self, rev):
+        """
+        Return a complete entry for the file version rev reached through any link
+        """
+        with self.lock:
+            entry = self.by_rev.get(rev)
+        if entry and os.path.isfile(entry["path"]) and os.path.getsize(entry["path"]) == entry["size"]:
+            return entry
+        return None
+
+    def update(self, link, metadata, path, content_hash=None):
+        entry = {
+            "name": metadata.name,
+            "size": metadata.size,
+            "rev": metadata.rev,
+            "content_hash": content_hash or dropbox_content_hash(path),
+            "path": path,
+        }
+        with self.lock:
+            self.entries[link] = entry
+            self.by_rev[entry["rev"]] = entry
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps([link, entry], ensure_ascii=False) + "\n")
+        return entry
+
+    def merge(self, entries):
+        """
+        Add the entries of another manifest, keeping this one's for links both have
+        Returns the number of links added
+        """
+        with self.lock:
+            added = 0
+            for link, entry in entries.items():
+                if link not in self.entries:
+                    self.entries[link] = entry
+                    self.by_rev.setdefault(entry["rev"], entry)
+                    added += 1
+            return added
+
+    def save(self):
+        with self.lock:
+            write_json_atomic(self.path, self.entries)
+            if os.path.isfile(self.log_path):
+                os.remove(self.log_path)
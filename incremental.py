@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+
+import pandas
+
+from downloads import write_json_atomic
+from utils import iter_excel_chunks, read_excel_cached
+
+
+def subtree_key(language, grade, subject, chapter):
+    return "/".join(str(part) for part in (language, grade, subject, chapter))
+
+
+def subtree_hashes(data):
+    """
+    Hash every Language > Grade > Subject > Chapter subtree of the parsed ChannelData
+    Returns a dict mapping subtree_key to the hash of everything below it
+    """
+    hashes = {}
+    for language, grade, subject, chapter in data.chapters():
+        # record reprs list every field in sheet order, which the tree follows too
+        encoded = repr(chapter).encode('utf-8')
+        hashes[subtree_key(language.name, grade.grade, subject.name, chapter.name)] = hashlib.sha1(encoded).hexdigest()
+    return hashes
+
+
+def row_hashes(xls, cache_dir=None, chunk_rows=None):
+    """
+    Hash every row of a spreadsheet, streaming it chunk_rows rows at a time if given
+    """
+    chunks = iter_excel_chunks(xls, chunk_rows) if chunk_rows else [read_excel_cached(xls, cache_dir)]
+    hashes = []
+    for data_from_xls in chunks:
+        hashes += ["{:016x}".format(value) for value in pandas.util.hash_pandas_object(data_from_xls, index=False).tolist()]
+    return hashes
+
+
+class IncrementalState(object):
+    """
+    Row and subtree hashes of the last successful run
+    State structure:
+        rows > sheet name > [row hash]
+        subtrees > subtree_key > hash
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        self.subtrees = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                try:
+                    state = json.loads(f.read())
+                    self.rows = state["rows"]
+                    self.subtrees = state["subtrees"]
+                except (ValueError, KeyError):
+                    print('Could not read incremental state {}. Rebuilding everything'.format(path))
+
+    def compare(self, subtrees, rows):
+        """
+        Compare this run's hashes against the saved ones
+        Returns a report of added, removed, modified and unchanged subtrees
+        and of the rows added and removed per sheet
+        """
+        report = {
+            "added": [key for key in subtrees if key not in self.subtrees],
+            "removed": [key for key in self.subtrees if key not in subtrees],
+            "modified": [key for key in subtrees if key in self.subtrees and self.subtrees[key] != subtrees[key]],
+            "unchanged": [key for key in subtrees if self.subtrees.get(key) == subtrees[key]],
+            "rows": {},
+        }
+        for sheet, hashes in rows.items():
+            old_hashes = set(self.rows.get(sheet, []))
+            new_hashes = set(hashes)
+            report["rows"][sheet] = {
+                "added": len(new_hashes - old_hashes),
+                "removed": len(old_hashes - new_hashes),
+                "total": len(hashes),
+            }
+        return report
+
+    def save(self, subtrees, rows):
+        self.subtrees = subtrees
+        self.rows = rows
+        write_json_atomic(self.path, {"rows": rows, "subtrees": subtrees})
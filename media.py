@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# target resolution and bitrates for pre-compressed videos
+VIDEO_PROFILES = {
+    "480p": {"max_height": 480, "video_bitrate": 700, "audio_bitrate": 64},
+    "360p": {"max_height": 360, "video_bitrate": 400, "audio_bitrate": 48},
+    "240p": {"max_height": 240, "video_bitrate": 250, "audio_bitrate": 32},
+}
+
+# workers never fork from the chef process, whose download threads may be running
+PROCESS_CONTEXT = multiprocessing.get_context("spawn")
+
+# longest side and jpeg quality of optimized assessment images
+IMAGE_MAX_SIZE = 1024
+JPEG_QUALITY = 85
+
+
+def available_cpus():
+    """
+    Number of CPU cores this process may run on, which on shared hosts and in
+    containers can be fewer than the host has
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def run_in_processes(function, jobs, workers=None):
+    """
+    Call function(*args) for every key > args of jobs in a pool of `workers`
+    processes (default: one per available CPU core)
+    Returns a dict mapping each key to what function returned or to the exception raised
+    """
+    results = {}
+    if not jobs:
+        return results
+    with ProcessPoolExecutor(max_workers=workers or available_cpus(), mp_context=PROCESS_CONTEXT) as executor:
+        futures = {key: executor.submit(function, *args) for key, args in jobs.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+    return results
+
+
+def transcode_video(source, target, profile):
+    """
+    Transcode source to an h264/aac mp4 at target using one ffmpeg thread, since
+    compress_videos already runs one process per core
+    The output is written next to target and moved into place once complete
+    """
+    tmp_target = "{}.tmp.mp4".format(target)
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error", "-i", source,
+        # never upscale, keep the width even as h264 requires
+        "-vf", "scale=-2:'min({},ih)'".format(profile["max_height"]),
+        "-c:v", "libx264", "-preset", "medium", "-threads", "1",
+        "-b:v", "{}k".format(profile["video_bitrate"]),
+        "-maxrate", "{}k".format(profile["video_bitrate"]),
+        "-bufsize", "{}k".format(2 * profile["video_bitrate"]),
+        "-c:a", "aac", "-b:a", "{}k".format(profile["audio_bitrate"]),
+        "-movflags", "+faststart",
+        tmp_target,
+    ]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        if os.path.isfile(tmp_target):
+            os.remove(tmp_target)
+        raise RuntimeError("ffmpeg failed on {}: {}".format(source, e.stderr.decode('utf-8', 'replace').strip()))
+    os.replace(tmp_target, target)
+    return target
+
+
+def check_video_profile(profile_name):
+    """
+    Raise if videos cannot be compressed with profile_name on this machine
+    Returns the profile
+    """
+    if profile_name not in VIDEO_PROFILES:
+        raise ValueError("Unknown video profile {}, use one of {}".format(profile_name, ", ".join(VIDEO_PROFILES)))
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg is needed to compress videos")
+    return VIDEO_PROFILES[profile_name]
+
+
+def compress_videos(sources, folder, profile_name, workers=None):
+    """
+    Compress videos in a pool of `workers` processes (default: one per available CPU core)
+    sources maps each video's content hash to its path. Outputs are cached as
+    folder/<profile>/<content hash>.mp4, so a video is only transcoded once per profile
+    Returns a dict mapping each content hash to the compressed path or to the exception raised
+    """
+    profile = check_video_profile(profile_name)
+    profile_folder = os.path.join(folder, profile_name)
+    os.makedirs(profile_folder, exist_ok=True)
+
+    results = {}
+    pending = {}
+    for content_hash, source in sources.items():
+        target = os.path.join(profile_folder, "{}.mp4".format(content_hash))
+        if os.path.isfile(target):
+            results[content_hash] = target
+        else:
+            pending[content_hash] = (source, target, profile)
+    results.update(run_in_processes(transcode_video, pending, workers))
+    return results
+
+
+def optimize_image(source, target, max_size):
+    """
+    Downscale source so its longest side is at most max_size and recompress it
+    in its own format. The original is kept when that does not make it smaller
+    """
+    tmp_target = "{}.tmp".format(target)
+    try:
+        with Image.open(source) as image:
+            image_format = image.format
+            resized = max(image.size) > max_size
+            if resized:
+                image.thumbnail((max_size, max_size), Image.LANCZOS)
+            if image_format == "JPEG":
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(tmp_target, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            elif image_format == "PNG":
+                image.save(tmp_target, "PNG", optimize=True)
+            elif resized:
+                image.save(tmp_target, image_format)
+            else:
+                shutil.copyfile(source, tmp_target)
+        if not resized and os.path.getsize(tmp_target) >= os.path.getsize(source):
+            shutil.copyfile(source, tmp_target)
+    except Exception:
+        if os.path.isfile(tmp_target):
+            os.remove(tmp_target)
+        raise
+    os.replace(tmp_target, target)
+    return target
+
+
+def optimize_images(sources, folder, max_size=IMAGE_MAX_SIZE, workers=None):
+    """
+    Optimize images in a pool of `workers` processes (default: one per available CPU core)
+    sources maps each image's sha256 to its path. Outputs are cached as
+    folder/<max_size>/<sha256><extension>, so an image is only optimized once per size
+    Returns a dict mapping each sha256 to the optimized path or to the exception raised
+    """
+    size_folder = os.path.join(folder, str(max_size))
+    os.makedirs(size_folder, exist_ok=True)
+
+    results = {}
+    pending = {}
+    for content_hash, source in sources.items():
+        extension = os.path.splitext(source)[1].lower()
+        target = os.path.join(size_folder, "{}{}".format(content_hash, extension))
+        if os.path.isfile(target):
+            results[content_hash] = target
+        else:
+            pending[content_hash] = (source, target, max_size)
+    results.update(run_in_processes(optimize_image, pending, workers))
+    return results
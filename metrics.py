@@ -0,0 +1,89 @@
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is left out of the report there
+    resource = None
+
+from downloads import write_json_atomic
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))], 4)
+
+
+class Metrics(object):
+    """
+    Wall time, call count, bytes and per call latency for each named stage of a run
+    Stages are recorded from any thread with `with METRICS.timed(stage):` or METRICS.add
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def stage(self, name):
+        # callers hold self.lock
+        return self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "bytes": 0, "latencies": []})
+
+    def add(self, name, seconds=0.0, nbytes=0, calls=1):
+        with self.lock:
+            stage = self.stage(name)
+            stage["calls"] += calls
+            stage["seconds"] += seconds
+            stage["bytes"] += nbytes
+            if calls:
+                stage["latencies"].append(seconds)
+
+    def add_bytes(self, name, nbytes):
+        self.add(name, nbytes=nbytes, calls=0)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def report(self):
+        """
+        Report structure:
+            stages > name > {calls, seconds, bytes, latency > {p50, p90, p99, max}}
+            peak_rss_mb
+        """
+        report = {"stages": {}}
+        with self.lock:
+            for name, stage in self.stages.items():
+                latencies = sorted(stage["latencies"])
+                report["stages"][name] = {
+                    "calls": stage["calls"],
+                    "seconds": round(stage["seconds"], 3),
+                    "bytes": stage["bytes"],
+                    "latency": {
+                        "p50": percentile(latencies, 0.5),
+                        "p90": percentile(latencies, 0.9),
+                        "p99": percentile(latencies, 0.99),
+                        "max": percentile(latencies, 1),
+                    },
+                }
+        if resource is not None:
+            # ru_maxrss is in KB on linux
+            report["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        return report
+
+    def write_report(self, path):
+        report = self.report()
+        write_json_atomic(path, report)
+        return report
+
+
+METRICS = Metrics()
@@ -0,0 +1,177 @@
+import sys
+
+CHAPTER_ASSESSMENT = "Chapter Assessment"
+
+
+class Record(object):
+    """
+    Base for the slotted records below: positional init over __slots__ and a
+    repr that lists every slot, used to fingerprint subtrees
+    """
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(getattr(self, name)) for name in self.__slots__))
+
+
+class Video(Record):
+    __slots__ = ("link", "title", "copyright", "license", "icon")
+
+    def to_dict(self):
+        return {"title": self.title, "copyright": self.copyright, "license": self.license, "icon": self.icon}
+
+
+class Question(Record):
+    __slots__ = ("id", "question", "question_image", "correct_answer", "all_answers")
+
+    def to_dict(self):
+        return {
+            "question": self.question,
+            "question_image": self.question_image,
+            "correct_answer": self.correct_answer,
+            "all_answers": self.all_answers
+        }
+
+
+class Topic(Record):
+    """
+    Videos keyed by link and questions keyed by question id, both in sheet order
+    """
+    __slots__ = ("name", "title", "source_id", "videos", "questions")
+
+    def __init__(self, name, parent_source_id):
+        title = name.title()
+        super(Topic, self).__init__(name, title, "{}-{}".format(parent_source_id, title), {}, {})
+
+    @property
+    def is_chapter_assessment(self):
+        return self.title == CHAPTER_ASSESSMENT
+
+    def to_dict(self):
+        questions = {question_id: question.to_dict() for question_id, question in self.questions.items()}
+        if self.name == CHAPTER_ASSESSMENT:
+            return questions
+        content = {}
+        if self.videos:
+            content["video"] = {link: video.to_dict() for link, video in self.videos.items()}
+        if questions:
+            content["assessment"] = questions
+        return content
+
+
+class Chapter(Record):
+    __slots__ = ("name", "title", "source_id", "topics")
+
+    def __init__(self, name, parent_source_id):
+        title = name.title()
+        super(Chapter, self).__init__(name, title, "{}-{}".format(parent_source_id, title), {})
+
+    def topic(self, name):
+        topic = self.topics.get(name)
+        if topic is None:
+            name = sys.intern(name)
+            topic = self.topics[name] = Topic(name, self.source_id)
+        return topic
+
+
+class Subject(Record):
+    __slots__ = ("name", "title", "source_id", "chapters")
+
+    def __init__(self, name, parent_source_id):
+        title = name.title()
+        super(Subject, self).__init__(name, title, "{}-{}".format(parent_source_id, title), {})
+
+    def chapter(self, name):
+        chapter = self.chapters.get(name)
+        if chapter is None:
+            name = sys.intern(name)
+            chapter = self.chapters[name] = Chapter(name, self.source_id)
+        return chapter
+
+
+class Grade(Record):
+    __slots__ = ("grade", "title", "source_id", "subjects")
+
+    def __init__(self, grade, parent_source_id):
+        super(Grade, self).__init__(grade, "Grade {}".format(grade), "{}-{}".format(parent_source_id, grade), {})
+
+    def subject(self, name):
+        subject = self.subjects.get(name)
+        if subject is None:
+            name = sys.intern(name)
+            subject = self.subjects[name] = Subject(name, self.source_id)
+        return subject
+
+
+class Language(Record):
+    __slots__ = ("name", "title", "source_id", "grades")
+
+    def __init__(self, name):
+        # convert to title to apply title case for node titles
+        title = name.title()
+        super(Language, self).__init__(name, title, title, {})
+
+    def grade(self, grade):
+        record = self.grades.get(grade)
+        if record is None:
+            record = self.grades[grade] = Grade(grade, self.source_id)
+        return record
+
+
+class ChannelData(object):
+    """
+    Parsed channel structure:
+        Language > Grade > Subject > Chapter > Topic Name > Videos and Questions
+    Node titles and source ids are derived once, when a record is created
+    """
+    __slots__ = ("languages",)
+
+    def __init__(self):
+        self.languages = {}
+
+    def language(self, name):
+        language = self.languages.get(name)
+        if language is None:
+            name = sys.intern(name)
+            language = self.languages[name] = Language(name)
+        return language
+
+    def topic(self, language, grade, subject, chapter, topic):
+        return self.language(language).grade(grade).subject(subject).chapter(chapter).topic(topic)
+
+    def chapters(self):
+        """
+        Yield (language, grade, subject, chapter) records for every chapter
+        """
+        for language in self.languages.values():
+            for grade in language.grades.values():
+                for subject in grade.subjects.values():
+                    for chapter in subject.chapters.values():
+                        yield language, grade, subject, chapter
+
+    def select(self, keep):
+        """
+        Drop every Language > Grade for which keep(language name, grade) is false,
+        and the languages left without grades
+        """
+        for name, language in list(self.languages.items()):
+            for grade in list(language.grades):
+                if not keep(name, grade):
+                    del language.grades[grade]
+            if not language.grades:
+                del self.languages[name]
+        return self
+
+    def to_dict(self):
+        """
+        The nested dict read_videos_xls and read_assessment_xls used to return
+        """
+        data = {}
+        for language, grade, subject, chapter in self.chapters():
+            data.setdefault(language.name, {}).setdefault(grade.grade, {}).setdefault(subject.name, {})[chapter.name] = \
+                {topic.name: topic.to_dict() for topic in chapter.topics.values()}
+        return data
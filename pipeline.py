@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from downloads import write_json_atomic
+
+
+class StageTimer(object):
+    """
+    Records when each stage of a run starts and ends, so the report can show
+    how long every pair of stages ran at the same time
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.mark(name, start, time.time())
+
+    def mark(self, name, start, end):
+        self.stages[name] = (start, end)
+
+    def report(self):
+        """
+        Report structure:
+            stages > name > {start, end, duration} in seconds since the timer was created
+            overlaps > name > other name > seconds both stages were running
+        """
+        report = {"stages": {}, "overlaps": {}}
+        for name, (start, end) in self.stages.items():
+            report["stages"][name] = {
+                "start": round(start - self.origin, 3),
+                "end": round(end - self.origin, 3),
+                "duration": round(end - start, 3),
+            }
+            report["overlaps"][name] = {}
+            for other, (other_start, other_end) in self.stages.items():
+                if other != name:
+                    report["overlaps"][name][other] = round(max(0, min(end, other_end) - max(start, other_start)), 3)
+        return report
+
+    def write_report(self, path):
+        report = self.report()
+        write_json_atomic(path, report)
+        return report
+
+
+class DownloadQueue(object):
+    """
+    Pool of workers that starts fetching items as soon as they are added
+    fetch(key, item) is called once per distinct key; whenever a worker frees up
+    it takes the pending item with the lowest priority, ties going to the first added
+    """
+    def __init__(self, fetch, concurrency):
+        self.fetch = fetch
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.futures = {}
+        self.pending = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+
+    def add(self, key, item, priority=()):
+        if key in self.futures:
+            return
+        if self.started is None:
+            self.started = time.time()
+        self.futures[key] = Future()
+        with self.lock:
+            heapq.heappush(self.pending, (priority, next(self.order), key, item))
+        # every task runs whichever pending item is first at the time it starts
+        self.executor.submit(self.run_next)
+
+    def run_next(self):
+        with self.lock:
+            priority, order, key, item = heapq.heappop(self.pending)
+        future = self.futures[key]
+        try:
+            future.set_result(self.fetch(key, item))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.finished = time.time()
+
+    def wait(self):
+        """
+        Block until every added item is fetched
+        Returns a dict mapping each key to what fetch returned, in the order keys were added
+        """
+        try:
+            results = {key: future.result() for key, future in self.futures.items()}
+        except BaseException:
+            # interrupted, e.g. by Ctrl-C: do not start the items still pending
+            self.cancel()
+            raise
+        self.executor.shutdown()
+        return results
+
+    def cancel(self):
+        """
+        Drop items that have not started and wait for the running ones
+        """
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,102 @@
+import glob
+import hashlib
+import json
+import os
+
+SHARDS_FOLDER = os.path.join("chefdata", "shards")
+
+
+def shard_key(language, grade):
+    return "{}>{}".format(language, grade)
+
+
+def shard_of(language, grade, count):
+    """
+    Shard in range(count) that a Language > Grade belongs to, the same on every machine and run
+    """
+    digest = hashlib.sha1(shard_key(language, grade).encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+class Shard(object):
+    """
+    The Language > Grade slices of the channel one chef run builds
+    languages and grades are sets of names (matched case insensitively), index/count
+    select the slices that shard_of assigns to shard index out of count
+    """
+    def __init__(self, languages=None, grades=None, index=None, count=None):
+        self.languages = languages
+        self.grades = grades
+        self.index = index
+        self.count = count
+
+    @property
+    def name(self):
+        """
+        Name of the shard's own chefdata area
+        """
+        parts = []
+        if self.languages:
+            parts.append("languages-{}".format("_".join(sorted(self.languages))))
+        if self.grades:
+            parts.append("grades-{}".format("_".join(sorted(self.grades))))
+        if self.count:
+            parts.append("shard-{}-of-{}".format(self.index, self.count))
+        return "-".join(parts).replace(" ", "_")
+
+    @property
+    def folder(self):
+        return os.path.join(SHARDS_FOLDER, self.name)
+
+    def includes(self, language, grade):
+        if self.languages and language.strip().lower() not in self.languages:
+            return False
+        if self.grades and str(grade).strip().lower() not in self.grades:
+            return False
+        return not self.count or shard_of(language, grade, self.count) == self.index
+
+
+def split_option(value):
+    return {part.strip().lower() for part in value.split(",") if part.strip()}
+
+
+def select_shard(options):
+    """
+    Shard selected by the languages=, grades= and shard=i/n command line options
+    (languages and grades as comma separated lists, i counting from 0), None if there are none
+    """
+    languages = split_option(options["languages"]) if options.get("languages") else None
+    grades = split_option(options["grades"]) if options.get("grades") else None
+    index = count = None
+    if options.get("shard"):
+        try:
+            index, count = (int(part) for part in options["shard"].split("/"))
+        except ValueError:
+            raise ValueError("shard must look like i/n, got {}".format(options["shard"]))
+        if not 0 <= index < count:
+            raise ValueError("shard index must be between 0 and {}, got {}".format(count - 1, index))
+    if not (languages or grades or count):
+        return None
+    return Shard(languages, grades, index, count)
+
+
+def chefdata_path(path, shard=None):
+    """
+    Move a path under chefdata into the chefdata area of shard, if any
+    """
+    if shard is None:
+        return path
+    moved = os.path.join(shard.folder, os.path.relpath(path, "chefdata"))
+    return os.path.abspath(moved) if os.path.isabs(path) else moved
+
+
+def shard_files(path):
+    """
+    Every shard's copy of the chefdata path, in shard name order
+    """
+    return sorted(glob.glob(os.path.join(SHARDS_FOLDER, "*", os.path.relpath(path, "chefdata"))))
+
+
+def read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
@@ -7,11 +7,24 @@ from le_utils.constants import exercises
 from le_utils.constants.languages import getlang_by_name
 from le_utils.constants import licenses as le_licenses
 from ricecooker.classes.questions import SingleSelectQuestion
+from ricecooker.exceptions import InvalidNodeException, InvalidQuestionException
 from utils import *
+from downloads import ContentStore, DownloadScheduler, VideoManifest, dropbox_content_hash, stream_shared_link_file, write_json_atomic
+from incremental import IncrementalState, row_hashes, subtree_hashes, subtree_key
+from pipeline import DownloadQueue, StageTimer
+from metrics import METRICS
+from media import IMAGE_MAX_SIZE, check_video_profile, compress_videos, optimize_images
+from shards import chefdata_path, read_json, select_shard, shard_files
 
+import cProfile
 import dropbox
 import json
+import requests
 import re
+import sys
+import threading
+import time
+import urllib.parse
 
 # Run constants
 ################################################################################
@@ -32,10 +45,25 @@ ASSESSMENT_XLS = os.path.join("files", "assessments.xls")
 CREDENTIALS = os.path.join("credentials", "credentials.json")
 VIDEO_FOLDER = os.path.abspath(os.path.join("chefdata", "videos"))
 SHEETS_FOLDER = os.path.abspath(os.path.join("chefdata", "sheets"))
+VIDEO_MANIFEST_JSON = os.path.join("chefdata", "video_manifest.json")
+INCREMENTAL_STATE_JSON = os.path.join("chefdata", "incremental_state.json")
+INCREMENTAL_REPORT_JSON = os.path.join("chefdata", "incremental_report.json")
+PIPELINE_REPORT_JSON = os.path.join("chefdata", "pipeline_report.json")
+METRICS_JSON = os.path.join("chefdata", "metrics.json")
+COMPRESSED_VIDEO_FOLDER = os.path.abspath(os.path.join("chefdata", "compressed"))
+OPTIMIZED_IMAGE_FOLDER = os.path.join("chefdata", "images")
+CPROFILE_STATS = os.path.join("chefdata", "cprofile.stats")
+VALIDATION_REPORT_JSON = os.path.join("chefdata", "validation_report.json")
+VALIDATION_FAILURES_LOG = os.path.join("chefdata", "validation_failures.jsonl")
 FAILED_LINKS_DIR = os.path.join("chefdata", "failed_links")
 FAILED_LINKS_JSON = os.path.join(FAILED_LINKS_DIR, "failed_links.json")
 FAILED_IMAGES_JSON = os.path.join(FAILED_LINKS_DIR, "failed_image_links.json")
+FAILURES_LOG = os.path.join(FAILED_LINKS_DIR, "failures.jsonl")
 TTL_MAIN_LOGO = os.path.join("files", "Images", "TTLFinalLogo.jpg")
+DEFAULT_CONCURRENCY = 8                                     # Parallel Dropbox downloads (override with concurrency=N)
+DEFAULT_RETRIES = 5                                         # Retries for rate limited or transient Dropbox errors
+DOWNLOAD_PRIORITIES = ("sheet", "grade", "smallest")        # Download order, first is the default
+MB = 1024 * 1024
 
 # The chef subclass
 ################################################################################
@@ -70,25 +98,268 @@ class TicTacLearnChef(SushiChef):
     # pre_run: to perform preliminary tasks, e.g., crawling and scraping website
     # __init__: if need to customize functionality or add command line arguments
 
-    def video_node_from_dropbox(self, video_details, link, token):
-        dbx = dropbox.Dropbox(token)
+    def __init__(self, *args, **kwargs):
+        super(TicTacLearnChef, self).__init__(*args, **kwargs)
+        self.arg_parser.add_argument('--profile', action='store_true',
+            help='Write per stage timings, call counts, bytes, latencies and peak RSS to {}'.format(METRICS_JSON))
+        self.arg_parser.add_argument('--cprofile', action='store_true',
+            help='With --profile, also write cProfile stats for the whole run to {}'.format(CPROFILE_STATS))
+        self.arg_parser.add_argument('--validate', action='store_true',
+            help='Parse the sheets and validate the whole channel tree offline, writing every problem to {}'.format(VALIDATION_REPORT_JSON))
+        # one dropbox client per download worker thread
+        self._local = threading.local()
+        # Language > Grade slices this run builds, None for the whole channel
+        self.shard = None
 
-        metadata, res = dbx.sharing_get_shared_link_file(url=link)
-        # get relative path to video file
-        video_path = os.path.relpath(os.path.join(VIDEO_FOLDER, metadata.name))
+    def chefdata_path(self, path):
+        return chefdata_path(path, self.shard)
 
+    def get_dropbox_client(self, token):
+        dbx = getattr(self._local, "dbx", None)
+        if dbx is None:
+            # DownloadScheduler.call does all the retrying, so retries=N holds for metadata calls too
+            dbx = dropbox.Dropbox(token, max_retries_on_error=0, max_retries_on_rate_limit=0)
+            self._local.dbx = dbx
+        return dbx
 
-        if not os.path.isfile(video_path):
-            with open(video_path, 'wb') as f:
-                f.write(res.content)
-        else:
+    def get_http_session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def throttle(self, nbytes):
+        METRICS.add_bytes("video_transfer", nbytes)
+        self.scheduler.throttle(nbytes)
+
+    def download_video(self, link, token):
+        """
+        Download the video behind a dropbox shared link into the video store
+        Returns the relative path to the local video file
+        """
+        dbx = self.get_dropbox_client(token)
+
+        # metadata only call, no file body is transferred
+        with METRICS.timed("dropbox_metadata"):
+            metadata = self.scheduler.call(dbx.sharing_get_shared_link_metadata, url=link)
+        if self.manifest.is_current(link, metadata):
             LOGGER.info("{} already downloaded. Skipping".format(metadata.name))
+            return self.manifest.get(link)["path"]
+
+        with self.store.lock_for(metadata.rev):
+            entry = self.manifest.find_by_rev(metadata.rev)
+            if entry is not None:
+                # same dropbox file shared through another link
+                LOGGER.info("{} already downloaded from another link. Skipping".format(metadata.name))
+                self.manifest.update(link, metadata, entry["path"], entry["content_hash"])
+                return entry["path"]
 
+            remote_hash = self.remote_content_hash(dbx, metadata)
+            # files downloaded by runs that predate the manifest are stored under their dropbox name
+            legacy_path = os.path.join(self.store.folder, metadata.name)
+            if self.manifest.get(link) is None and os.path.isfile(legacy_path) and os.path.getsize(legacy_path) == metadata.size \
+                    and (remote_hash is None or dropbox_content_hash(legacy_path) == remote_hash):
+                LOGGER.info("{} already downloaded. Adding to manifest".format(metadata.name))
+                download_path = legacy_path
+            else:
+                with self.scheduler.reserve_disk(metadata.size, self.disk_priority(link, metadata)), \
+                        METRICS.timed("video_transfer"):
+                    download_path = self.scheduler.call(
+                        stream_shared_link_file, self.get_http_session(), token, link, metadata,
+                        self.store.part_path(metadata), throttle=self.throttle
+                    )
+
+            stored_path, content_hash = self.store.add(download_path, metadata.name, remote_hash)
+            # get relative path to video file
+            video_path = os.path.relpath(stored_path)
+            self.manifest.update(link, metadata, video_path, content_hash)
+
+        return video_path
+
+    def remote_content_hash(self, dbx, metadata):
+        """
+        Dropbox content_hash of the file behind a shared link, or None if it can't be read
+        Shared link metadata has no content_hash, so it is looked up by path, which is only
+        reported for files in the token owner's Dropbox. Other files are only checked by size
+        """
+        if not getattr(metadata, "path_lower", None):
+            return None
+        try:
+            with METRICS.timed("dropbox_metadata"):
+                return getattr(self.scheduler.call(dbx.files_get_metadata, metadata.path_lower), "content_hash", None)
+        except dropbox.exceptions.ApiError as e:
+            print("Could not get the content hash of {}: {}. Checking its size only".format(metadata.name, e))
+            return None
+
+    def video_priority(self, link, topic_key):
+        """
+        Order in which queued videos are started, lowest first
+        """
+        if self.priority == "grade":
+            grade = topic_key[1]
+            try:
+                return (float(grade), str(grade))
+            except (TypeError, ValueError):
+                return (float("inf"), str(grade))
+        if self.priority == "smallest":
+            # sizes are only known up front for links seen by earlier runs
+            entry = self.manifest.get(link)
+            return (entry["size"] if entry else float("inf"),)
+        return ()
+
+    def disk_priority(self, link, metadata):
+        """
+        Order in which transfers waiting for disk budget are let in, lowest first
+        """
+        if self.priority == "smallest":
+            return (metadata.size,)
+        return self.priorities.get(link, ())
+
+    def start_downloads(self, token, concurrency=DEFAULT_CONCURRENCY, incremental=False, scheduler=None, priority="sheet"):
+        """
+        Start a pool of `concurrency` workers that download videos as they are added with queue.add(link, video)
+        In incremental mode workers hold off until reuse_videos is called with the links that
+        may be taken from the manifest without any dropbox call
+        scheduler caps bandwidth, disk use and retries for every worker, priority is one of DOWNLOAD_PRIORITIES
+        Failed links are added to the failure report as they happen
+        """
+        self.manifest = VideoManifest(self.chefdata_path(VIDEO_MANIFEST_JSON))
+        self.store = ContentStore(self.chefdata_path(VIDEO_FOLDER))
+        self.scheduler = scheduler or DownloadScheduler()
+        self.priority = priority
+        self.priorities = {}
+        self.reusable = set()
+        self.reuse_ready = threading.Event()
+        if not incremental:
+            self.reuse_ready.set()
+
+        def fetch(link, video):
+            self.reuse_ready.wait()
+            start = time.time()
+            entry = self.manifest.get_complete(link) if link in self.reusable else None
+            if entry is not None:
+                return entry["path"]
+            try:
+                return self.download_video(link, token)
+            except Exception as e:
+                print(e)
+                print("Error getting video from dropbox with link: {}".format(link))
+                self.add_to_failed(link, video.title, "video", "download_video", e, time.time() - start)
+                return e
+
+        LOGGER.info("Downloading videos with {} workers in {} order".format(concurrency, priority))
+        return DownloadQueue(fetch, concurrency)
+
+    def queue_video(self, queue, link, video, topic_key):
+        priority = self.priorities.setdefault(link, self.video_priority(link, topic_key))
+        queue.add(link, video, priority)
+
+    def reuse_videos(self, data, unchanged_subtrees=()):
+        """
+        Let the download workers start, reusing manifest entries for links in unchanged_subtrees
+        """
+        unchanged_subtrees = set(unchanged_subtrees)
+        for language, grade, subject, chapter in data.chapters():
+            if subtree_key(language.name, grade.grade, subject.name, chapter.name) in unchanged_subtrees:
+                for topic in chapter.topics.values():
+                    self.reusable.update(topic.videos)
+        self.reuse_ready.set()
+
+    def merge_shard_manifests(self):
+        """
+        Add the videos downloaded by every shard run to the manifest and let the
+        download workers reuse them without any dropbox call
+        """
+        for path in shard_files(VIDEO_MANIFEST_JSON):
+            added = self.manifest.merge(VideoManifest(path).entries)
+            LOGGER.info("Merged {} videos from {}".format(added, path))
+        self.reusable.update(self.manifest.entries)
+
+    def merge_shard_failures(self):
+        """
+        Add the failed images reports of every shard run to this run's reports
+        Shard link failures are left out: this run retries every link no shard
+        downloaded, so its own report already says which of them still fail
+        """
+        for images_json in shard_files(FAILED_IMAGES_JSON):
+            FAILURES.merge_images(read_json(images_json))
+
+    def finish_downloads(self, queue):
+        """
+        Wait for every queued video
+        Returns a dict mapping each link to its local path or to the exception raised
+        """
+        try:
+            return queue.wait()
+        finally:
+            self.manifest.save()
+
+    def abort_downloads(self, queue):
+        # never leave workers blocked if parsing failed before reuse_videos
+        self.reuse_ready.set()
+        queue.cancel()
+        self.manifest.save()
+
+    def precompress_videos(self, videos, profile, workers=None):
+        """
+        Compress downloaded videos with the given media.VIDEO_PROFILES profile, once per content hash
+        Returns videos with each path replaced by the compressed copy, keeping the
+        original when compression fails
+        """
+        sources = {}
+        for link, video_path in videos.items():
+            if not isinstance(video_path, Exception):
+                sources.setdefault(self.manifest.get(link)["content_hash"], video_path)
+
+        LOGGER.info("Compressing {} videos to {}".format(len(sources), profile))
+        compressed = compress_videos(sources, self.chefdata_path(COMPRESSED_VIDEO_FOLDER), profile, workers)
+
+        results = {}
+        for link, video_path in videos.items():
+            if isinstance(video_path, Exception):
+                results[link] = video_path
+                continue
+            compressed_path = compressed[self.manifest.get(link)["content_hash"]]
+            if isinstance(compressed_path, Exception):
+                print(compressed_path)
+                print("Error compressing video with link: {}. Using the original".format(link))
+                results[link] = video_path
+            else:
+                results[link] = os.path.relpath(compressed_path)
+        return results
+
+    def optimize_question_images(self, data, max_size=IMAGE_MAX_SIZE, workers=None):
+        """
+        Replace every question image of data by a downscaled and recompressed copy,
+        optimizing byte identical images only once
+        Images that are missing or fail to optimize are left as they are
+        """
+        sources = {}
+        image_hashes = {}
+        for path in question_image_paths(data):
+            if os.path.isfile(path):
+                image_hashes[path] = file_sha256(path)
+                sources.setdefault(image_hashes[path], path)
+
+        LOGGER.info("Optimizing {} distinct images out of {} referenced".format(len(sources), len(image_hashes)))
+        optimized = optimize_images(sources, self.chefdata_path(OPTIMIZED_IMAGE_FOLDER), max_size, workers)
+
+        replacements = {}
+        for path, image_hash in image_hashes.items():
+            if isinstance(optimized[image_hash], Exception):
+                print(optimized[image_hash])
+                print("Error optimizing image: {}. Using the original".format(path))
+            else:
+                replacements[path] = optimized[image_hash]
+        return replace_question_images(data, replacements)
+
+    def video_node_from_dropbox(self, video, video_path):
         video_file = files.VideoFile(path = video_path)
 
         video_node = nodes.VideoNode(
-            title = video_details["title"],
-            source_id = link,
+            title = video.title,
+            source_id = video.link,
             license = licenses.CC_BYLicense("TicTacLearn"),
             files = [video_file]
         )
@@ -96,130 +367,121 @@ class TicTacLearnChef(SushiChef):
         return video_node
 
     # returns an array of questions
-    def create_question(self, question_data):
+    # if a problems list is given, questions that cannot be built are added to it and left out
+    def create_question(self, questions, problems=None):
         question_arr = []
 
-        for id, question_metadata in question_data:
-            if question_metadata["question"] is None:
-                question_text = question_metadata["question_image"]
-            else:
-                question_text = question_metadata["question"] if question_metadata["question_image"] == None else question_metadata["question"] + " " +question_metadata["question_image"]
-
-            question = SingleSelectQuestion(
-                id = id,
-                question = question_text,
-                correct_answer = question_metadata["correct_answer"],
-                all_answers = question_metadata["all_answers"],
-                hints = []
-            )
-            question_arr.append(question)
+        with METRICS.timed("create_question"):
+            for question_record in questions:
+                try:
+                    if question_record.question is None:
+                        question_text = question_record.question_image
+                    else:
+                        question_text = question_record.question if question_record.question_image == None else question_record.question + " " + question_record.question_image
+
+                    question = SingleSelectQuestion(
+                        id = question_record.id,
+                        question = question_text,
+                        correct_answer = question_record.correct_answer,
+                        all_answers = question_record.all_answers,
+                        hints = []
+                    )
+                except Exception as e:
+                    if problems is None:
+                        raise
+                    problems.append("Question {}: {}: {}".format(question_record.id, type(e).__name__, e))
+                    continue
+                question_arr.append(question)
         
         return question_arr
 
-    def upload_content(self, data, access_token, channel):
-        for language, language_value in data.items():
-            # convert to title to apply title case for node titles
-            language = language.title()
-            language_node = nodes.TopicNode(
-                title = language,
-                source_id = language,
-                author = "TicTacLearn",
-                description = '',
-                thumbnail = TTL_MAIN_LOGO,
-                language = getlang_by_name(language)
-            )
-            for grade, grade_value in language_value.items():
-                grade_node = nodes.TopicNode(
-                    title = 'Grade {}'.format(grade),
-                    source_id = "{}-{}".format(language, grade),
-                    author = "TicTacLearn",
-                    description= '',
-                    thumbnail = TTL_MAIN_LOGO,
-                    language=getlang_by_name(language)
-                )
-                
-                for subject, subject_value in grade_value.items():
-                    subject = subject.title()
-                    subject_node = nodes.TopicNode(
-                        title = subject,
-                        source_id = "{}-{}-{}".format(language, grade,subject),
-                        author = "TicTacLearn",
-                        description= '',
-                        thumbnail = TTL_MAIN_LOGO,
-                        language=getlang_by_name(language) 
-                    )
-                    for chapter, chapter_value in subject_value.items():
-                        chapter = chapter.title()
-                        chapter_node = nodes.TopicNode(
-                            title = chapter,
-                            source_id = "{}-{}-{}-{}".format(language, grade, subject, chapter),
-                            author = "TicTacLearn",
-                            description= '',
-                            thumbnail = TTL_MAIN_LOGO,
-                            language=getlang_by_name(language)
-                        )
-                        for topic, topic_value in chapter_value.items():
-                            topic = topic.title()
-                            if topic == "Chapter Assessment":
-                                questions = self.create_question(topic_value.items())
-                                exercise_node = nodes.ExerciseNode(
-                                    source_id = "{}-{}-{}-{}-{}".format(language, grade, subject,chapter, topic),
-                                    title = topic,
-                                    author = "TicTacLearn",
-                                    description = "Chapter Assessment",
-                                    language = getlang_by_name(language),
-                                    license = licenses.CC_BYLicense("TicTacLearn"),
-                                    thumbnail = TTL_MAIN_LOGO,
-                                    exercise_data = {
-                                        "mastery_model": exercises.M_OF_N,
-                                        "m": len(questions),
-                                        "n": len(questions),
-                                        "randomize": True
-                                    },
-                                    questions = questions
-                                )
-                                chapter_node.add_child(exercise_node)
-                            else:
-                                topic_node = nodes.TopicNode(
-                                    title = topic,
-                                    source_id = "{}-{}-{}-{}-{}".format(language, grade, subject, chapter, topic),
-                                    author = "TicTacLearn",
-                                    description= '',
-                                    thumbnail = TTL_MAIN_LOGO,
-                                    language=getlang_by_name(language)
-                                )
-                                for content_type, content in topic_value.items():
-                                    if content_type == "video":
-                                        for link, details in content.items():
-                                            try:
-                                                video_node = self.video_node_from_dropbox(details, link, access_token)
-                                                topic_node.add_child(video_node)
-                                            except Exception as e:
-                                                print(e)
-                                                print("Error getting video from dropbox with link: {}".format(link))
-                                                self.add_to_failed(link, details, content_type)
-                                                continue
-                                    else:
-                                        # content type is assessment
-                                        questions = self.create_question(content.items())
-                                        exercise_node = nodes.ExerciseNode(
-                                            source_id = "{}-{}-{}-{}-{}-Assessment".format(language, grade, subject, chapter, topic),
-                                            title = "{} Assessment".format(topic),
-                                            author = "TicTacLearn",
-                                            description = "{} Assessment".format(topic),
-                                            license = licenses.CC_BYLicense("TicTacLearn"),
-                                            thumbnail = TTL_MAIN_LOGO,
-                                            exercise_data = {
-                                                "mastery_model": exercises.M_OF_N,
-                                                "m": len(questions),
-                                                "n": len(questions),
-                                                "randomize": True
-                                            },
-                                            questions = questions
-                                        )
-                                        topic_node.add_child(exercise_node)
-
-                                chapter_node.add_child(topic_node)
+    def exercise_node(self, source_id, title, description, questions, language=None, problems=None):
+        questions = self.create_question(questions, problems)
+        return nodes.ExerciseNode(
+            source_id = source_id,
+            title = title,
+            author = "TicTacLearn",
+            description = description,
+            language = language,
+            license = licenses.CC_BYLicense("TicTacLearn"),
+            thumbnail = TTL_MAIN_LOGO,
+            exercise_data = {
+                "mastery_model": exercises.M_OF_N,
+                "m": len(questions),
+                "n": len(questions),
+                "randomize": True
+            },
+            questions = questions
+        )
+
+    def topic_node(self, record, language):
+        return nodes.TopicNode(
+            title = record.title,
+            source_id = record.source_id,
+            author = "TicTacLearn",
+            description = '',
+            thumbnail = TTL_MAIN_LOGO,
+            language = language
+        )
+
+    def build_exercises(self, data, problems=None):
+        """
+        Build every exercise node up front, keyed by source id
+        If a problems list is given, exercises and questions that cannot be built
+        are added to it and left out instead of raising
+        """
+        exercises = {}
+        for language, grade, subject, chapter in data.chapters():
+            lang = getlang_by_name(language.title)
+            for topic in chapter.topics.values():
+                if topic.is_chapter_assessment:
+                    source_id = topic.source_id
+                    args = (source_id, topic.title, "Chapter Assessment", topic.questions.values(), lang)
+                elif topic.questions:
+                    source_id = "{}-Assessment".format(topic.source_id)
+                    title = "{} Assessment".format(topic.title)
+                    args = (source_id, title, title, topic.questions.values())
+                else:
+                    continue
+                try:
+                    exercises[source_id] = self.exercise_node(*args, problems=problems)
+                except Exception as e:
+                    if problems is None:
+                        raise
+                    problems.append("Exercise {}: {}: {}".format(source_id, type(e).__name__, e))
+        return exercises
+
+    def upload_content(self, data, channel, videos, exercises):
+        """
+        Assemble the channel tree from parsed data, downloaded video paths and prebuilt exercises
+        """
+        for language in data.languages.values():
+            lang = getlang_by_name(language.title)
+            language_node = self.topic_node(language, lang)
+            for grade in language.grades.values():
+                grade_node = self.topic_node(grade, lang)
+                for subject in grade.subjects.values():
+                    subject_node = self.topic_node(subject, lang)
+                    for chapter in subject.chapters.values():
+                        chapter_node = self.topic_node(chapter, lang)
+                        for topic in chapter.topics.values():
+                            if topic.is_chapter_assessment:
+                                if topic.source_id in exercises:
+                                    chapter_node.add_child(exercises[topic.source_id])
+                                continue
+
+                            topic_node = self.topic_node(topic, lang)
+                            for link, video in topic.videos.items():
+                                video_path = videos[link]
+                                if isinstance(video_path, Exception):
+                                    # already reported by download_videos
+                                    continue
+                                topic_node.add_child(self.video_node_from_dropbox(video, video_path))
+                            exercise = exercises.get("{}-Assessment".format(topic.source_id))
+                            if exercise is not None:
+                                # exercises that failed to build are only left out in validate mode
+                                topic_node.add_child(exercise)
+                            chapter_node.add_child(topic_node)
                         subject_node.add_child(chapter_node)
                     grade_node.add_child(subject_node)
                 language_node.add_child(grade_node)
@@ -232,28 +494,135 @@ class TicTacLearnChef(SushiChef):
         result = re.search(regex, url)
         return result.group(1)
 
-    def add_to_failed(self, link, details, content_type):
-        with open(FAILED_LINKS_JSON, encoding = 'utf-8') as f:
+    def add_to_failed(self, link, title, content_type, stage, exception=None, elapsed=None):
+        FAILURES.add_link(link, title, content_type, stage, exception, elapsed)
+
+    def log_pipeline_report(self, report):
+        for name, stage in report["stages"].items():
+            overlaps = ", ".join("{} {:.1f}s".format(other, seconds) for other, seconds in report["overlaps"][name].items() if seconds)
+            LOGGER.info("Stage {}: {:.1f}s{}".format(name, stage["duration"], " (overlapped {})".format(overlaps) if overlaps else ""))
+
+    def log_incremental_report(self, report):
+        with open(self.chefdata_path(INCREMENTAL_REPORT_JSON), 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=4, ensure_ascii=False)
+        for sheet, counts in report["rows"].items():
+            LOGGER.info("{}: {} rows added, {} rows removed of {}".format(sheet, counts["added"], counts["removed"], counts["total"]))
+        for change in ("added", "removed", "modified"):
+            for key in report[change]:
+                LOGGER.info("Chapter {}: {}".format(change, key))
+        LOGGER.info("{} chapters unchanged, reusing their downloads".format(len(report["unchanged"])))
+
+    def run(self, args, options):
+        """
+        With --profile, time the whole run and write the metrics report (and with
+        --cprofile the cProfile stats) once ricecooker has finished uploading
+        With --validate, only check the sheets and exit with status 1 if there are problems
+        Shard runs only build a slice of the channel, so they must be dry runs
+        """
+        if args.get("validate"):
+            if self.validate_channel(**options):
+                sys.exit(1)
+            return
+        if select_shard(options) is not None and args["command"] != "dryrun":
+            raise ValueError("shard, languages and grades only build part of the channel; "
+                             "run them with dryrun and upload with merge_shards=true")
+        if not args.get("profile"):
+            return super(TicTacLearnChef, self).run(args, options)
+
+        METRICS.reset()
+        profiler = cProfile.Profile() if args.get("cprofile") else None
+        start = time.time()
+        if profiler:
+            profiler.enable()
+        try:
+            super(TicTacLearnChef, self).run(args, options)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(chefdata_path(CPROFILE_STATS, select_shard(options)))
+            total = time.time() - start
+            METRICS.add("run", total)
+            # everything ricecooker does after construct_channel: file processing and upload to Studio
+            construct = METRICS.report()["stages"].get("construct_channel", {}).get("seconds", 0)
+            METRICS.add("ricecooker_upload", total - construct)
+            metrics_json = chefdata_path(METRICS_JSON, select_shard(options))
+            METRICS.write_report(metrics_json)
+            LOGGER.info("Metrics written to {}".format(metrics_json))
+
+    def placeholder_video_path(self, link):
+        # the file name of a shared link, so the VideoFile extension check still applies
+        return urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(link).path)) or "placeholder.mp4"
+
+    def validate_node(self, node, path, problems, source_ids):
+        """
+        Run the ricecooker validation of node and every node below it, adding
+        each failure to problems instead of stopping at the first one
+        """
+        path = "{} > {}".format(path, node.title) if path else node.title
+        if not isinstance(node, nodes.VideoNode):
+            source_ids.setdefault(node.source_id, []).append(path)
+        try:
+            node.validate()
+        except (InvalidNodeException, AssertionError, ValueError) as e:
+            problems.append("{}: {}".format(path, e))
+        for question in getattr(node, "questions", []):
             try:
-                data = json.loads(f.read())
-            except:
-                # no data in json file
-                print('no data in json file')
-                with open(FAILED_LINKS_JSON, 'w', encoding='utf-8') as json_file:
-                    dict_failed = {}
-                    dict_failed[link] = {}
-                    dict_failed[link]["title"] = details["title"]
-                    dict_failed[link]["type"] = content_type
-                    json.dump(dict_failed, json_file, indent = 4, ensure_ascii=False)
-                    return
-            
-            with open(FAILED_LINKS_JSON, 'w', encoding = 'utf-8') as json_file:
-                data[link] = {}
-                data[link]["title"] = details["title"]
-                data[link]["type"]= content_type
-                json.dump(data, json_file, indent=4, ensure_ascii=False)
-                return
-    
+                question.validate()
+            except (InvalidQuestionException, AssertionError) as e:
+                problems.append("{} > question {}: {}".format(path, question.id, e))
+        for child in node.children:
+            self.validate_node(child, path, problems, source_ids)
+
+    def validate_channel(self, **kwargs):
+        """
+        Parse both sheets and build the whole tree with placeholder video files, without
+        credentials or any network call, then validate every node
+        Problems are logged and written to VALIDATION_REPORT_JSON all at once
+        Duplicate source ids are reported for topics and exercises; the same video link
+        in several topics is reused content, which ricecooker accepts
+        Returns the list of problems
+        """
+        start = time.time()
+        problems = []
+        chunk_rows = int(kwargs.get("chunk_rows", DEFAULT_CHUNK_ROWS)) if kwargs.get("stream", "false").lower() == "true" else None
+        FAILURES.start(VALIDATION_FAILURES_LOG)
+        try:
+            data = read_videos_xls(VIDEOS_XLS, SHEETS_FOLDER, chunk_rows=chunk_rows, problems=problems)
+            data = read_assessment_xls(ASSESSMENT_XLS, data, SHEETS_FOLDER, chunk_rows, problems)
+        finally:
+            FAILURES.close()
+        for grade, chapters in FAILURES.images.items():
+            for chapter, images in chapters.items():
+                for image in images:
+                    problems.append("Missing image {}/{}/{}".format(grade, chapter, image["image"]))
+        for language in data.languages.values():
+            if getlang_by_name(language.title) is None:
+                problems.append("Language {} is not a known le_utils language".format(language.title))
+
+        videos = {}
+        for language, grade, subject, chapter in data.chapters():
+            for topic in chapter.topics.values():
+                for link, video in topic.videos.items():
+                    if isinstance(link, str):
+                        videos[link] = self.placeholder_video_path(link)
+                    else:
+                        # skipped by upload_content like a failed download
+                        videos[link] = ValueError("No link for video {}".format(video.title))
+                        problems.append("{}: no link for video {}".format(topic.source_id, video.title))
+        channel = self.upload_content(data, self.get_channel(), videos, self.build_exercises(data, problems))
+
+        source_ids = {}
+        self.validate_node(channel, "", problems, source_ids)
+        for source_id, paths in source_ids.items():
+            if len(paths) > 1:
+                problems.append("Duplicate source_id {}: {}".format(source_id, " | ".join(paths)))
+
+        write_json_atomic(VALIDATION_REPORT_JSON, {"problems": problems})
+        for problem in problems:
+            LOGGER.error(problem)
+        LOGGER.info("Validated the channel in {:.1f}s: {} problems, report written to {}".format(
+            time.time() - start, len(problems), VALIDATION_REPORT_JSON))
+        return problems
 
     def construct_channel(self, *args, **kwargs):
         """
@@ -265,26 +634,30 @@ class TicTacLearnChef(SushiChef):
             "fr" will be passed along to `construct_channel` as kwargs['lang'].
         Returns: ChannelNode
         """
+        with METRICS.timed("construct_channel"):
+            return self.build_channel(*args, **kwargs)
+
+    def build_channel(self, *args, **kwargs):
         """
         Channel structure:
             Language > Grade > Subject > Chapter > Topic Name > Content
         """
         channel = self.get_channel(*args, **kwargs)  # Create ChannelNode from data in self.channel_info
 
-        if os.path.exists(FAILED_LINKS_DIR):
-            os.remove(FAILED_LINKS_JSON)
-        else:
-            os.makedirs(FAILED_LINKS_DIR, exist_ok=True)
-        
-        if not os.path.exists(VIDEO_FOLDER):
-            os.makedirs(VIDEO_FOLDER, exist_ok=True)
+        self.shard = select_shard(kwargs)
+        merge_shards = kwargs.get("merge_shards", "false").lower() == "true"
+        if self.shard is not None and merge_shards:
+            raise ValueError("merge_shards builds the whole channel and cannot be combined with a shard selection")
+        if self.shard is not None:
+            LOGGER.info("Building shard {} into {}".format(self.shard.name, self.shard.folder))
+
+        FAILURES.start(self.chefdata_path(FAILURES_LOG))
+
+        if not os.path.exists(self.chefdata_path(VIDEO_FOLDER)):
+            os.makedirs(self.chefdata_path(VIDEO_FOLDER), exist_ok=True)
 
-        if not os.path.exists(SHEETS_FOLDER):
-            os.makedirs(SHEETS_FOLDER, exist_ok=True)
-        with open(FAILED_LINKS_JSON, 'w+'):
-            pass
-        with open(FAILED_IMAGES_JSON, 'w+'):
-            pass
+        if not os.path.exists(self.chefdata_path(SHEETS_FOLDER)):
+            os.makedirs(self.chefdata_path(SHEETS_FOLDER), exist_ok=True)
 
         # set up dropbox credentials
         with open(CREDENTIALS, 'r') as myfile:
@@ -294,12 +667,85 @@ class TicTacLearnChef(SushiChef):
         access_token = creds['dropbox_token']
 
 
-        data = read_videos_xls(VIDEOS_XLS)
-        data = read_assessment_xls(ASSESSMENT_XLS, data)
+        concurrency = int(kwargs.get("concurrency", DEFAULT_CONCURRENCY))
+        incremental = kwargs.get("incremental", "false").lower() == "true"
+        # stream=true reads the sheets chunk_rows rows at a time instead of loading them whole
+        chunk_rows = int(kwargs.get("chunk_rows", DEFAULT_CHUNK_ROWS)) if kwargs.get("stream", "false").lower() == "true" else None
+        timer = StageTimer()
+        priority = kwargs.get("priority", DOWNLOAD_PRIORITIES[0])
+        if priority not in DOWNLOAD_PRIORITIES:
+            raise ValueError("priority must be one of {}".format(", ".join(DOWNLOAD_PRIORITIES)))
+        if "compress" in kwargs:
+            # fail before downloading anything rather than once every video is in
+            check_video_profile(kwargs["compress"])
+        scheduler = DownloadScheduler(
+            bytes_per_second=float(kwargs["bandwidth"]) * MB if "bandwidth" in kwargs else None,
+            max_disk_bytes=float(kwargs["disk_budget"]) * MB if "disk_budget" in kwargs else None,
+            retries=int(kwargs.get("retries", DEFAULT_RETRIES)),
+        )
+        downloads = self.start_downloads(access_token, concurrency, incremental, scheduler, priority)
+        if merge_shards:
+            self.merge_shard_manifests()
 
-        channel = self.upload_content(data, access_token, channel)
-        
+        def on_video(link, video, topic_key):
+            if self.shard is None or self.shard.includes(topic_key[0], topic_key[1]):
+                self.queue_video(downloads, link, video, topic_key)
+
+        try:
+            # videos are queued for download as soon as their rows are parsed,
+            # the incremental check only holds back the workers until parsing ends
+            with timer.stage("parse_videos"):
+                data = read_videos_xls(VIDEOS_XLS, self.chefdata_path(SHEETS_FOLDER), on_video=on_video, chunk_rows=chunk_rows)
+            with timer.stage("parse_assessments"):
+                data = read_assessment_xls(ASSESSMENT_XLS, data, self.chefdata_path(SHEETS_FOLDER), chunk_rows)
+            if self.shard is not None:
+                # assessments are matched against the whole tree, so only trim it once both sheets are in
+                data = data.select(self.shard.includes)
+
+            if incremental:
+                state = IncrementalState(self.chefdata_path(INCREMENTAL_STATE_JSON))
+                subtrees = subtree_hashes(data)
+                rows = {
+                    "videos": row_hashes(VIDEOS_XLS, self.chefdata_path(SHEETS_FOLDER), chunk_rows),
+                    "assessments": row_hashes(ASSESSMENT_XLS, self.chefdata_path(SHEETS_FOLDER), chunk_rows),
+                }
+                report = state.compare(subtrees, rows)
+                self.log_incremental_report(report)
+                self.reuse_videos(data, report["unchanged"])
+
+            if kwargs.get("optimize_images", "false").lower() == "true":
+                with timer.stage("optimize_images"):
+                    workers = int(kwargs["compress_workers"]) if "compress_workers" in kwargs else None
+                    max_size = int(kwargs.get("image_max_size", IMAGE_MAX_SIZE))
+                    data = self.optimize_question_images(data, max_size, workers)
+
+            with timer.stage("build_exercises"):
+                exercises = self.build_exercises(data)
+            videos = self.finish_downloads(downloads)
+            if downloads.started is not None:
+                timer.mark("download_videos", downloads.started, downloads.finished)
+
+            if "compress" in kwargs:
+                with timer.stage("compress_videos"):
+                    workers = int(kwargs["compress_workers"]) if "compress_workers" in kwargs else None
+                    videos = self.precompress_videos(videos, kwargs["compress"], workers)
+
+            with timer.stage("assemble_tree"):
+                channel = self.upload_content(data, channel, videos, exercises)
+
+            if incremental:
+                # only a run that got this far becomes the baseline for the next one
+                state.save(subtrees, rows)
+        except BaseException:
+            # KeyboardInterrupt included, so Ctrl-C does not wait for every queued download
+            self.abort_downloads(downloads)
+            raise
+        finally:
+            if merge_shards:
+                self.merge_shard_failures()
+            FAILURES.write_reports(self.chefdata_path(FAILED_LINKS_JSON), self.chefdata_path(FAILED_IMAGES_JSON))
 
+        self.log_pipeline_report(timer.write_report(self.chefdata_path(PIPELINE_REPORT_JSON)))
         return channel
 
 
@@ -1,210 +1,596 @@
 import pandas
+import hashlib
 import os
 import json
-FAILED_IMAGES_JSON = os.path.join("chefdata", "failed_links", "failed_image_links.json")
-def read_videos_xls(xls):
-    """
-    Build dict for channel structure
-    Dict structure:
-        Language > Grade > Subject > Chapter > Topic Name > Content Type > Content
-    """
-    data_from_xls = pandas.read_excel(xls, keep_default_na=False, na_values='')
-    data_dict = {}
-    # building dict row by row
-    for index, row in data_from_xls.iterrows():
-        # Skip any content that does not have a link and all assessments
-        # as we will be getting assessment data from a separate xls
-        if row["Link to Content"] == "N/A" or row["Content Type"] == "Assessment":
+import re
+import threading
+from pandas.io.parsers import TextParser
+from downloads import write_json_atomic
+from metrics import METRICS
+from model import CHAPTER_ASSESSMENT, ChannelData, Question, Video
+SHEET_FINGERPRINTS = "fingerprints.json"
+DEFAULT_CHUNK_ROWS = 5000    # rows per DataFrame when sheets are streamed
+IMAGES_DIR = os.path.join("files", "Images")
+IMAGE_MARKDOWN = re.compile(r"!\[\]\(([^)]+)\)")
+IMAGE_INDEX = None    # normalized image path > path on disk, filled on first get_image_path call
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_excel_cached(xls, cache_dir=None):
+    """
+    pandas.read_excel with the parsed sheet pickled under cache_dir
+    The cache is keyed by file size, mtime and content hash: the content is only
+    hashed again when size or mtime change, and a changed hash invalidates the cache
+    """
+    if cache_dir is None:
+        with METRICS.timed("read_excel"):
+            return pandas.read_excel(xls, keep_default_na=False, na_values='')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprints_path = os.path.join(cache_dir, SHEET_FINGERPRINTS)
+    fingerprints = {}
+    if os.path.isfile(fingerprints_path):
+        with open(fingerprints_path, encoding='utf-8') as f:
+            try:
+                fingerprints = json.loads(f.read())
+            except ValueError:
+                print('no data in json file')
+
+    key = os.path.abspath(xls)
+    stat = os.stat(xls)
+    fingerprint = fingerprints.get(key, {})
+    if fingerprint.get("size") != stat.st_size or fingerprint.get("mtime") != stat.st_mtime:
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(xls)}
+
+    name = os.path.splitext(os.path.basename(xls))[0]
+    cache_path = os.path.join(cache_dir, "{}.{}.pkl".format(name, fingerprint["sha256"]))
+    data_from_xls = None
+    if os.path.isfile(cache_path):
+        try:
+            with METRICS.timed("read_sheet_cache"):
+                data_from_xls = pandas.read_pickle(cache_path)
+        except Exception as e:
+            # written by another pandas version, or truncated
+            print('Could not read sheet cache {}: {}. Parsing the sheet again'.format(cache_path, e))
+            os.remove(cache_path)
+    if data_from_xls is None:
+        with METRICS.timed("read_excel"):
+            data_from_xls = pandas.read_excel(xls, keep_default_na=False, na_values='')
+        # drop caches of older versions of this sheet
+        stale_path = fingerprints.get(key, {}).get("cache")
+        if stale_path and os.path.isfile(stale_path):
+            os.remove(stale_path)
+        tmp_path = "{}.tmp".format(cache_path)
+        data_from_xls.to_pickle(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    fingerprint["cache"] = cache_path
+    fingerprints[key] = fingerprint
+    write_json_atomic(fingerprints_path, fingerprints)
+    return data_from_xls
+
+
+def excel_cell(value, data_type):
+    """
+    Convert an openpyxl cell the way pandas.read_excel does
+    """
+    if value is None:
+        return ""
+    if data_type == "e":
+        return float("nan")
+    if data_type == "n":
+        as_int = int(value)
+        return as_int if as_int == value else float(value)
+    return value
+
+
+def xls_cell(value, cell_type, datemode):
+    """
+    Convert an xlrd cell the way pandas.read_excel does
+    """
+    import xlrd
+    if cell_type == xlrd.XL_CELL_DATE:
+        try:
+            return xlrd.xldate.xldate_as_datetime(value, datemode)
+        except OverflowError:
+            return value
+    if cell_type == xlrd.XL_CELL_ERROR:
+        return float("nan")
+    if cell_type == xlrd.XL_CELL_BOOLEAN:
+        return bool(value)
+    if cell_type == xlrd.XL_CELL_NUMBER and value == value and abs(value) != float("inf"):
+        as_int = int(value)
+        return as_int if as_int == value else value
+    return value
+
+
+def excel_rows(xls):
+    """
+    Yield the rows of the first sheet of xls one at a time, converted like pandas.read_excel
+    xlsx rows have their trailing empty cells trimmed, as pandas does
+    Returns a generator; pandas picks the reader from the file contents, not its name, and so does this
+    """
+    with open(xls, 'rb') as f:
+        is_xlsx = f.read(4) == b"PK\x03\x04"
+    if is_xlsx:
+        import openpyxl
+        with open(xls, 'rb') as f:
+            workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+            try:
+                sheet = workbook.worksheets[0]
+                sheet.reset_dimensions()
+                for row in sheet.rows:
+                    values = [excel_cell(cell.value, cell.data_type) for cell in row]
+                    while values and values[-1] == "":
+                        values.pop()
+                    yield values
+            finally:
+                workbook.close()
+    else:
+        import xlrd
+        # xlrd keeps the whole sheet in memory, but legacy xls sheets are capped at 65536 rows
+        workbook = xlrd.open_workbook(xls, on_demand=True)
+        try:
+            sheet = workbook.sheet_by_index(0)
+            for i in range(sheet.nrows):
+                yield [xls_cell(value, cell_type, workbook.datemode)
+                    for value, cell_type in zip(sheet.row_values(i), sheet.row_types(i))]
+        finally:
+            workbook.release_resources()
+
+
+def cell_kind(value):
+    """
+    What kind of value a cell holds as far as pandas dtype inference goes
+    """
+    if isinstance(value, float) and value.is_integer():
+        return "integral float"
+    if isinstance(value, str):
+        try:
+            float(value)
+            return "numeric text"
+        except ValueError:
+            return "text"
+    return type(value).__name__
+
+
+def scan_excel(xls):
+    """
+    First pass of iter_excel_chunks: count the rows pandas.read_excel keeps and
+    collect one value of every kind found in each column
+    A chunk parsed together with these witness values gets the dtypes of the whole sheet
+    Returns (rows including the header, width, witness rows)
+    """
+    rows = width = 0
+    witnesses = []
+    present = []
+    for number, values in enumerate(excel_rows(xls)):
+        if values:
+            rows = number + 1
+        width = max(width, len(values))
+        if number == 0:
             continue
-        # adding language keys to dict
-        # converting strings to lower due to inconsistent naming convention in xls
-        language = row["Language"].lower().strip()
-        if language not in data_dict:
-            data_dict[language] = {}
-        
-        # addingggrade keys to dict
-        grade = row["Grade"]
-        if grade not in data_dict[language]:
-            data_dict[language][grade] = {}
+        while len(witnesses) < len(values):
+            witnesses.append({})
+            present.append(0)
+        for column, value in enumerate(values):
+            if value != "":
+                witnesses[column].setdefault(cell_kind(value), value)
+                present[column] += 1
+    witnesses += [{} for _ in range(width - len(witnesses))]
+    present += [0] * (width - len(present))
+
+    columns = []
+    for column_witnesses, count in zip(witnesses, present):
+        values = list(column_witnesses.values())
+        if count < rows - 1:
+            values.append("")
+        columns.append(values)
+    depth = max([len(values) for values in columns] + [0]) if rows > 1 else 0
+    # pad every column by repeating its first witness
+    witness_rows = [[values[min(i, len(values) - 1)] if values else "" for values in columns] for i in range(depth)]
+    return rows, width, witness_rows
+
+
+def excel_chunk(header, rows, witness_rows, start):
+    """
+    DataFrame of the sheet rows from start on, with the dtypes of the whole sheet
+    """
+    parser = TextParser([header] + witness_rows + rows, header=0, keep_default_na=False, na_values='', skip_blank_lines=False)
+    chunk = parser.read().iloc[len(witness_rows):]
+    chunk.index = pandas.RangeIndex(start, start + len(chunk))
+    return chunk
 
-        subject = row["Subject"].lower().strip()
-        if subject not in data_dict[language][grade]:
-            data_dict[language][grade][subject] = {}
 
-        chapter_num = row["Chapter No"]
-        chapter_name = row["Chapter Name"].lower().strip()
-        chapter = "{} - {}".format(chapter_num, chapter_name)
+def iter_excel_chunks(xls, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Yield the first sheet of xls as DataFrames of at most chunk_rows rows, never
+    holding more than one chunk, that concatenate to what pandas.read_excel returns
+    The sheet is read twice: once to find the dtype of every column and once to build the chunks
+    """
+    with METRICS.timed("scan_excel"):
+        total_rows, width, witness_rows = scan_excel(xls)
+    if total_rows == 0:
+        return
+    rows = excel_rows(xls)
+    try:
+        header = next(rows)
+        header = header + [""] * (width - len(header))
+        chunk = []
+        start = 0
+        for number, values in enumerate(rows, 1):
+            if number >= total_rows:
+                break
+            chunk.append(values + [""] * (width - len(values)))
+            if len(chunk) == chunk_rows or number == total_rows - 1:
+                with METRICS.timed("read_excel_chunk"):
+                    data_from_xls = excel_chunk(header, chunk, witness_rows, start)
+                yield data_from_xls
+                start += len(chunk)
+                chunk = []
+        if start == 0:
+            # header only sheet
+            yield excel_chunk(header, [], witness_rows, 0)
+    finally:
+        rows.close()
 
-        if chapter not in data_dict[language][grade][subject]:
-            data_dict[language][grade][subject][chapter] = {}
 
+def read_videos_xls(xls, cache_dir=None, on_video=None, chunk_rows=None, problems=None):
+    """
+    Build ChannelData for channel structure
+    Structure:
+        Language > Grade > Subject > Chapter > Topic Name > Videos
+    on_video(link, video, topic_key) is called for every video as soon as it is parsed,
+    topic_key being its (language, grade, subject, chapter, topic)
+    With chunk_rows the sheet is streamed chunk_rows rows at a time instead of loaded whole
+    Rows with an unsupported content type are added to problems, if given
+    """
+    if chunk_rows:
+        data = ChannelData()
+        seen = set()
+        for data_from_xls in iter_excel_chunks(xls, chunk_rows):
+            with METRICS.timed("build_videos_tree"):
+                videos_from_dataframe(data_from_xls, on_video, data, seen, problems)
+        return data
+    data_from_xls = read_excel_cached(xls, cache_dir)
+    with METRICS.timed("build_videos_tree"):
+        return videos_from_dataframe(data_from_xls, on_video, problems=problems)
 
 
-        topic_name = row["Topic Name"].lower().strip()
-        if topic_name not in data_dict[language][grade][subject][chapter]:
-            data_dict[language][grade][subject][chapter][topic_name] = {}
+def normalize_column(column):
+    # converting strings to lower due to inconsistent naming convention in xls
+    return column.str.lower().str.strip()
 
-        # adding chapter assessment
-        # data_dict[language][grade][subject][chapter][topic_name]["chapter assessment"] = {}
-        
+
+def videos_from_dataframe(data_from_xls, on_video=None, data=None, seen=None, problems=None):
+    """
+    Build the read_videos_xls ChannelData from an already loaded videos sheet
+    Columns are normalized in bulk and each link is added once, in sheet order
+    To add a sheet chunk by chunk, pass the same data and seen set with every chunk
+    """
+    # Skip any content that does not have a link and all assessments
+    # as we will be getting assessment data from a separate xls
+    keep = (data_from_xls["Link to Content"] != "N/A") & (data_from_xls["Content Type"] != "Assessment")
+    rows = data_from_xls[keep]
+    if data is None:
+        data = ChannelData()
+    if rows.empty:
+        # a streamed chunk can hold assessment rows only
+        return data
+
+    levels = pandas.DataFrame({
+        "language": normalize_column(rows["Language"]),
+        "grade": rows["Grade"],
+        "subject": normalize_column(rows["Subject"]),
+        "chapter": rows["Chapter No"].map(str) + " - " + normalize_column(rows["Chapter Name"]),
+        "topic": normalize_column(rows["Topic Name"]),
         # Assessment = Exercise, Video = Video
-        content_type = row["Content Type"].lower().strip()
-        if content_type not in data_dict[language][grade][subject][chapter][topic_name]:
-            data_dict[language][grade][subject][chapter][topic_name][content_type] = {}
-
-        link = row["Link to Content"].lower().strip()
-        if link not in data_dict[language][grade][subject][chapter][topic_name][content_type]:
-            data_dict[language][grade][subject][chapter][topic_name][content_type][link] = {
-                "title": row["Video/Assessment Title"],
-                "copyright": row["Copyright"],
-                "license": row["License"],
-                "icon": row["Icon"]
-            }
-    return data_dict
-
-
-def read_assessment_xls(xls, data):
-    data_from_xls = pandas.read_excel(xls, keep_default_na=False, na_values = '')
-    # to map to correct option given which is the right answer
-    for index, row in data_from_xls.iterrows():
-        question_parts = [x.strip() for x in row["Question Set Name"].split("|")]
-        topic = None
-        chapter_title = None
-
-        if len(question_parts) == 4:
-            # if length === 4, then chapter assessment
-            # if chapter assessment, chapter is located at str_parts[0]
-            chapter_title = question_parts[0]
-        elif len(question_parts) == 5:
-            # if normal assessment, chapter is located at str_parts[1] and topic is located at str_parts[0]
-            topic = question_parts[0].lower()
-            chapter_title = question_parts[1].strip()
-        else:
-            print("Error: Question Set Name not in correct format")
-            # self.add_to_failed(row["Medium"], row["Question Set Name"], row["QuestionText"])
+        "content_type": normalize_column(rows["Content Type"]),
+        "link": normalize_column(rows["Link to Content"]),
+        "title": rows["Video/Assessment Title"],
+        "copyright": rows["Copyright"],
+        "license": rows["License"],
+        "icon": rows["Icon"],
+    })
+    # first row of each link wins, like the row by row builder did
+    key_columns = ["language", "grade", "subject", "chapter", "topic", "content_type", "link"]
+    levels = levels.drop_duplicates(subset=key_columns, keep="first")
+    if seen is not None:
+        # and across chunks, nan keys matching each other like in drop_duplicates
+        keys = [tuple(None if value != value else value for value in key)
+            for key in zip(*[levels[column].tolist() for column in key_columns])]
+        new = [not (key in seen or seen.add(key)) for key in keys]
+        levels = levels[new]
+
+    topic_key = topic_record = None
+    columns = [levels[column].tolist() for column in levels.columns]
+    for language, grade, subject, chapter, topic, content_type, link, title, copyright, license, icon in zip(*columns):
+        if content_type != "video":
+            print("Error: unsupported content type {} for {}".format(content_type, link))
+            if problems is not None:
+                problems.append("Unsupported content type {} for {}".format(content_type, link))
             continue
+        # rows of a topic are mostly contiguous, so only walk the tree when the topic changes
+        if topic_key != (language, grade, subject, chapter, topic):
+            topic_key = (language, grade, subject, chapter, topic)
+            topic_record = data.topic(*topic_key)
+        video = topic_record.videos[link] = Video(link, title, copyright, license, icon)
+        if on_video is not None:
+            on_video(link, video, topic_key)
+    return data
+
+
+def read_assessment_xls(xls, data, cache_dir=None, chunk_rows=None, problems=None):
+    """
+    Add the questions of the assessments sheet to the read_videos_xls ChannelData
+    With chunk_rows the sheet is streamed chunk_rows rows at a time instead of loaded whole
+    Sheet problems are collected in problems instead of raised, if given
+    """
+    if chunk_rows:
+        for data_from_xls in iter_excel_chunks(xls, chunk_rows):
+            with METRICS.timed("build_assessments_tree"):
+                add_assessments_from_dataframe(data_from_xls, data, problems)
+        return data
+    data_from_xls = read_excel_cached(xls, cache_dir)
+    with METRICS.timed("build_assessments_tree"):
+        return add_assessments_from_dataframe(data_from_xls, data, problems)
+
+
+def or_none(column):
+    # missing cells become None instead of NaN
+    column = column.astype(object)
+    return column.where(column.notnull(), None)
+
+
+def image_markdown(column):
+    return or_none(column.map(lambda image: "![]({})".format(get_image_path(image)), na_action="ignore"))
+
+
+def add_assessments_from_dataframe(data_from_xls, data, problems=None):
+    """
+    Add the questions of an already loaded assessments sheet to the read_videos_xls ChannelData
+    Every column is resolved for the whole sheet at once and questions are then
+    merged into data one question set at a time
+    If a problems list is given, rows with an invalid AnswerNo and question sets whose
+    language, grade or subject is missing from data are added to it and skipped instead of raising KeyError
+    """
+    question_parts = data_from_xls["Question Set Name"].str.split("|")
+    part_count = question_parts.str.len()
+    valid = part_count.isin([4, 5])
+    for name in data_from_xls.loc[~valid, "Question Set Name"].tolist():
+        print("Error: Question Set Name not in correct format")
+        if problems is not None:
+            problems.append("Question Set Name not in correct format: {}".format(name))
+    rows = data_from_xls[valid]
+    question_parts = question_parts[valid]
+    if rows.empty:
+        return data
+
+    # if length === 4, then chapter assessment and chapter is located at str_parts[0]
+    # if normal assessment, chapter is located at str_parts[1] and topic is located at str_parts[0]
+    is_topic = part_count[valid] == 5
+    first_part = question_parts.str[0].str.strip()
+    second_part = question_parts.str[1].str.strip()
+    topics = or_none(first_part.str.lower().where(is_topic))
+    chapter_title = second_part.where(is_topic, first_part)
+
+    languages = rows["Medium"].str.lower()
+    # provided xls from TTL has Subject listed as mathematics on videos.xls and math/maths in assessments.xls
+    subjects = rows["Subject"].str.lower().where(~rows["Subject"].isin(["Math", "Maths"]), "mathematics")
+    chapters = (rows["ChapterNo"].map(str) + " - " + chapter_title).str.lower()
+
+    # some questions only have an image with no text
+    question_text = or_none(rows["QuestionText"])
+    # None if no associate question image
+    question_image = image_markdown(rows["QuestionImage"])
 
-        language = row["Medium"].lower()
-        grade = row["Class"]
-        if row["Subject"] == "Math" or row["Subject"] == "Maths":
-            # provided xls from TTL has Subject listed as mathematics on videos.xls and math/maths in assessments.xls
-            subject = 'mathematics'
-        else:
-            subject = row["Subject"].lower()
-        
-        chapter = "{} - {}".format(row["ChapterNo"], chapter_title).lower()
-        content_type = "assessment"
-        
-        # some questions only have an image with no text
-        question_text = row["QuestionText"] if not pandas.isnull(row["QuestionText"]) else None
-        
-        question_id = row["QuestionId"]
-
-
-        question_image = None    # None if no associate question image
-        # will remain None if there is no option (ex: yes or no question will only have 2 options)
-        option_one = None
-        option_two = None
-        option_three = None
-        option_four = None
+    # an option is its text, else its image, else None (ex: yes or no question will only have 2 options)
+    options = []
+    for number in range(1, 5):
+        option_text = or_none(rows["Option{}".format(number)])
+        # only look up the images of options without text, like the row by row parser did
+        option_image = image_markdown(rows.loc[option_text.isnull(), "Option{}Image".format(number)])
+        options.append(or_none(option_text.where(option_text.notnull(), option_image.reindex(rows.index))))
+
+    answered = rows["AnswerNo"].isin([1, 2, 3, 4])
+    invalid_answers = rows.loc[~answered, ["QuestionId", "AnswerNo"]]
+    if len(invalid_answers) and problems is None:
+        raise KeyError(invalid_answers["AnswerNo"].iloc[0])
+    for question_id, answer_no in zip(invalid_answers["QuestionId"].tolist(), invalid_answers["AnswerNo"].tolist()):
+        problems.append("Question {}: invalid AnswerNo {}".format(question_id, answer_no))
+    correct_answer = pandas.Series(None, index=rows.index, dtype=object)
+    for number, option in enumerate(options, 1):
+        correct_answer = correct_answer.where(rows["AnswerNo"] != number, option)
+
+    # group questions by question set so the tree is walked once per set
+    question_sets = {}
+    columns = [answered, languages, rows["Class"], subjects, chapters, topics, rows["QuestionId"],
+        question_text, question_image, correct_answer] + options
+    for is_answered, language, grade, subject, chapter, topic, question_id, text, image, answer, *row_options in zip(*[column.tolist() for column in columns]):
+        if not is_answered:
+            continue
         # holds all available answers
-        answers = []
-        # query which column the options are located in and if there is a question Image
-        if not pandas.isnull(row["QuestionImage"]):
-            question_image = "![]({})".format(get_image_path(row["QuestionImage"]))
-            
-        
-        if (not pandas.isnull(row["Option1"])) or (not pandas.isnull(row["Option1Image"])):
-            option_one = row["Option1"] if not pandas.isnull(row["Option1"]) else "![]({})".format(get_image_path(row["Option1Image"]))
-            answers.append(option_one)
-
-        if (not pandas.isnull(row["Option2"])) or (not pandas.isnull(row["Option2Image"])):
-            option_two = row["Option2"] if not pandas.isnull(row["Option2"]) else "![]({})".format(get_image_path(row["Option2Image"]))
-            answers.append(option_two)
-
-        if (not pandas.isnull(row["Option3"])) or (not pandas.isnull(row["Option3Image"])):
-            option_three = row["Option3"] if not pandas.isnull(row["Option3"]) else "![]({})".format(get_image_path(row["Option3Image"]))
-            answers.append(option_three)
-
-        if (not pandas.isnull(row["Option4"])) or (not pandas.isnull(row["Option4Image"])):
-            option_four = row["Option4"] if not pandas.isnull(row["Option4"]) else "![]({})".format(get_image_path(row["Option4Image"]))
-            answers.append(option_four)
-
-        answer_key = {
-            1: option_one,
-            2: option_two,
-            3: option_three,
-            4: option_four,
-        }
-        
-        answer = answer_key[row["AnswerNo"]]
-
-        if len(answers) > 4:
-            print(answers)
-        
-        question_metadata = {
-            "question": question_text,
-            "question_image": question_image,
-            "correct_answer": answer,
-            "all_answers": answers
-        }
+        all_answers = [option for option in row_options if option is not None]
+        question_sets.setdefault((language, grade, subject, chapter, topic), {})[question_id] = \
+            Question(question_id, text, image, answer, all_answers)
 
+    for (language, grade, subject, chapter, topic), questions in question_sets.items():
         # check if chapter exists as some chapters only appear on assessment excel
-        if chapter not in data[language][grade][subject]:
-            data[language][grade][subject][chapter] = {}
-
-        # have to check if topic exists
-        if topic:
-            if topic not in data[language][grade][subject][chapter]:
-                data[language][grade][subject][chapter][topic] = {}
-                # add in assessment array. array will hold each question's metadata
-            if content_type not in data[language][grade][subject][chapter][topic]:
-                data[language][grade][subject][chapter][topic][content_type] = {}
-            data[language][grade][subject][chapter][topic][content_type][question_id] = question_metadata
-            # print(data[language][grade][subject][chapter][topic][content_type])
-        else:
-            chapter_assessment = "Chapter Assessment"
-            if chapter_assessment not in data[language][grade][subject][chapter]:
-                data[language][grade][subject][chapter][chapter_assessment] = {}
-            data[language][grade][subject][chapter][chapter_assessment][question_id] = question_metadata
-            # print(data[language][grade][subject][chapter][chapter_assessment])
-
-
-        # location where to add question objects
+        try:
+            chapter_record = data.languages[language].grades[grade].subjects[subject].chapter(chapter)
+        except KeyError:
+            if problems is None:
+                raise
+            problems.append("Questions {}: {} > Grade {} > {} is not in videos.xls".format(
+                ", ".join(str(question_id) for question_id in questions), language, grade, subject))
+            continue
+        chapter_record.topic(topic or CHAPTER_ASSESSMENT).questions.update(questions)
 
     return data
 
+def normalize_image_path(image_path):
+    # client Images folder names are inconsistent in spacing and case
+    return "/".join(part for part in image_path.replace("\\", "/").replace(" ", "").lower().split("/") if part)
+
+
+def build_image_index(images_dir=IMAGES_DIR):
+    """
+    Scan images_dir once and map each normalized path (relative to files/) to the real path
+    """
+    index = {}
+    base_dir = os.path.dirname(images_dir)
+    for dirpath, dirnames, filenames in os.walk(images_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            index.setdefault(normalize_image_path(os.path.relpath(path, base_dir)), path)
+    return index
+
+
 def get_image_path(imageString):
-    path_arr = imageString.replace(" ", "").split('/')
-    path = os.path.join('files', *path_arr)
-    if not os.path.isfile(path):
+    global IMAGE_INDEX
+    if IMAGE_INDEX is None:
+        IMAGE_INDEX = build_image_index()
+    path = IMAGE_INDEX.get(normalize_image_path(imageString))
+    if path is None:
+        path_arr = imageString.replace(" ", "").split('/')
+        path = os.path.join('files', *path_arr)
         add_to_failed(path_arr)
     return path
 
 
+def question_image_paths(data):
+    """
+    Paths of every image embedded in the questions of data
+    """
+    paths = set()
+    for language, grade, subject, chapter in data.chapters():
+        for topic in chapter.topics.values():
+            for question in topic.questions.values():
+                for text in [question.question_image, question.correct_answer] + question.all_answers:
+                    if text:
+                        paths.update(IMAGE_MARKDOWN.findall(text))
+    return paths
+
+
+def replace_question_images(data, replacements):
+    """
+    Point the image markdown of every question in data to replacements[path], if any
+    """
+    replace = lambda match: "![]({})".format(replacements.get(match.group(1), match.group(1)))
+    swap = lambda text: IMAGE_MARKDOWN.sub(replace, text) if text else text
+    for language, grade, subject, chapter in data.chapters():
+        for topic in chapter.topics.values():
+            for question in topic.questions.values():
+                question.question_image = swap(question.question_image)
+                question.correct_answer = swap(question.correct_answer)
+                question.all_answers = [swap(answer) for answer in question.all_answers]
+    return data
+
+
 def add_to_failed(path_arr):
-    grade = path_arr[1]
-    chapter = path_arr[2]
-    image_name = path_arr[3]
-    with open(FAILED_IMAGES_JSON, encoding = 'utf-8') as f:
-        try:
-            data = json.loads(f.read())
-        except:
-            # no data in json file
-            print('no data in json file')
-            with open(FAILED_IMAGES_JSON, 'w', encoding='utf-8') as json_file:
-                dict_failed = {}
-                dict_failed[grade] = {}
-                dict_failed[grade][chapter] = []
-                dict_failed[grade][chapter].append(image_name)
-                json.dump(dict_failed, json_file, indent = 4, ensure_ascii=False)
-                return
-        
-        with open(FAILED_IMAGES_JSON, 'w', encoding = 'utf-8') as json_file:
-            if grade not in data:
-                data[grade] = {}
-            if chapter not in data[grade]:
-                data[grade][chapter] = []
-            data[grade][chapter].append(image_name)
-            json.dump(data, json_file, indent=4, ensure_ascii=False)
-            return
\ No newline at end of file
+    FAILURES.add_image(path_arr, stage="read_assessment_xls", exception_type="FileNotFoundError")
+
+
+class FailureCollector(object):
+    """
+    Collects failed links and images for the whole run
+    Failures are kept in memory, appended to a jsonl log as they happen and
+    written out as the failed links/images reports once at the end of the run
+    Report structure:
+        failed links: link > {title, type, stage, exception, message, elapsed}
+        failed images: Grade > Chapter > [{image, stage, exception, message, elapsed}]
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.links = {}
+        self.images = {}
+        self.log = None
+
+    def start(self, log_path):
+        """
+        Forget earlier failures and start a new jsonl log at log_path
+        """
+        with self.lock:
+            self.links = {}
+            self.images = {}
+            if self.log is not None:
+                self.log.close()
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self.log = open(log_path, 'w', encoding='utf-8')
+
+    def record(self, kind, key, stage, exception=None, exception_type=None, elapsed=None):
+        return {
+            "kind": kind,
+            "key": key,
+            "stage": stage,
+            "exception": exception_type or (type(exception).__name__ if exception else None),
+            "message": str(exception) if exception else None,
+            "elapsed": round(elapsed, 3) if elapsed is not None else None,
+        }
+
+    def append(self, entry):
+        if self.log is not None:
+            self.log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.log.flush()
+
+    def add_link(self, link, title, content_type, stage, exception=None, elapsed=None):
+        entry = self.record("link", link, stage, exception, elapsed=elapsed)
+        with self.lock:
+            self.links[link] = {
+                "title": title,
+                "type": content_type,
+                "stage": entry["stage"],
+                "exception": entry["exception"],
+                "message": entry["message"],
+                "elapsed": entry["elapsed"],
+            }
+            self.append(entry)
+
+    def add_image(self, path_arr, stage, exception=None, exception_type=None, elapsed=None):
+        grade = path_arr[1]
+        chapter = path_arr[2]
+        image_name = path_arr[3]
+        entry = self.record("image", "/".join(path_arr), stage, exception, exception_type, elapsed)
+        with self.lock:
+            self.images.setdefault(grade, {}).setdefault(chapter, []).append({
+                "image": image_name,
+                "stage": entry["stage"],
+                "exception": entry["exception"],
+                "message": entry["message"],
+                "elapsed": entry["elapsed"],
+            })
+            self.append(entry)
+
+    def merge_images(self, images):
+        """
+        Add the failed images report of another run, skipping images this run reported too
+        """
+        with self.lock:
+            for grade, chapters in images.items():
+                for chapter, entries in chapters.items():
+                    known = self.images.setdefault(grade, {}).setdefault(chapter, [])
+                    reported = {entry["image"] for entry in known}
+                    known.extend(entry for entry in entries if entry["image"] not in reported)
+
+    def write_reports(self, links_json, images_json):
+        with self.lock:
+            for path, data in ((links_json, self.links), (images_json, self.images)):
+                with open(path, 'w', encoding='utf-8') as json_file:
+                    json.dump(data, json_file, indent=4, ensure_ascii=False)
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+
+FAILURES = FailureCollector()